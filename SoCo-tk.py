@@ -1,17 +1,30 @@
 #!/usr/bin/env python
 
+import bisect
+import collections
+import concurrent.futures
 import contextlib as clib
+import json
 import logging
+import threading
 import tkinter as tk
 import traceback
 import platform
 import os
 import sqlite3 as sql
-from io import BytesIO
+import time
+import zlib
 from io import StringIO
 
 from utils import parse_time
-import requests
+import artwork
+import health
+import lagwatch
+import library
+import metrics
+import perf
+import queue_model
+import replay
 from tkinter import messagebox
 
 try:
@@ -51,6 +64,39 @@ if platform.system() == 'Windows':
 elif platform.system() == 'Linux':
     USER_DATA = './data/'
 
+# Main loop lag probe: interval of the heartbeat and the lateness (both in ms)
+# from which a beat is counted as late.
+LAG_INTERVAL = 250
+LAG_THRESHOLD = 50
+
+# A beat later than this (ms) is treated as a stall, the main thread's stack
+# gets logged and the worst STALLS_KEPT stalls are kept for the report.
+STALL_THRESHOLD = 500
+STALLS_KEPT = 10
+
+# Socket timeout (seconds) for speaker requests, an unreachable speaker
+# should not hold the main loop for the library default.
+SPEAKER_TIMEOUT = 3.0
+
+if hasattr(soco, 'config'):
+    soco.config.REQUEST_TIMEOUT = SPEAKER_TIMEOUT
+
+# Queue entries fetched per request when loading a queue
+QUEUE_PAGE = 500
+
+# Decode album art in a separate process instead of a thread, and how often
+# (ms) the Tk thread looks for finished art.
+ART_DECODE_PROCESSES = False
+ART_POLL = 30
+
+# How often (ms) the session snapshot is saved, and how often the check of a
+# restored session against the speakers is looked at.
+SESSION_SAVE_INTERVAL = 60000
+SESSION_POLL = 200
+
+# How often (ms) the library browser looks for a finished page
+LIBRARY_POLL = 50
+
 
 
 """
@@ -64,7 +110,7 @@ soco.core.SoCo.__str__=better_display
 
 class SonosList(tk.PanedWindow):
 
-    def __init__(self, parent):
+    def __init__(self, parent, recorder = None, player = None):
         self.__parent = parent
         tk.PanedWindow.__init__(self, parent, sashrelief = tk.RAISED)
 
@@ -77,7 +123,11 @@ class SonosList(tk.PanedWindow):
                   sticky = 'news')
 
         self.__list_content = []
-        self.__queue_content = []
+        self.__queue_content = queue_model.CompactQueue()
+        # Speaker the queue content was loaded from
+        self.__queue_speaker = None
+        self.__queue_view = None
+        self._shown_filter = ''
 
         self._control_buttons = {}
         self.now_playing_widget = {}
@@ -89,6 +139,42 @@ class SonosList(tk.PanedWindow):
         self.empty_info = '-'
         self.label_queue = '{} - {}'
 
+        # Speaker traffic goes to the network, is recorded on its way there
+        # or is answered from a recording
+        self._recorder = recorder
+        self._player = player
+        self._invoke = self.__invoke
+        self._discover = soco.discover
+        fetch = artwork.fetch
+        if recorder is not None:
+            self._invoke = recorder.wrap_call(self._invoke)
+            self._discover = recorder.wrap_discover(self._discover)
+            fetch = recorder.wrap_fetch(fetch)
+        elif player is not None:
+            self._invoke = player.call
+            self._discover = player.discover
+            fetch = player.fetch
+
+        self._perf_overlay = None
+        self._perf_refresh = None
+        self._library_browser = None
+        self._art_loader = artwork.ArtLoader(processes = ART_DECODE_PROCESSES,
+                                             timeout = SPEAKER_TIMEOUT,
+                                             fetch = fetch)
+        self._art_url = None
+        self._art_pending = []
+        self._art_polling = False
+        self._last_track = None
+        self._session_saved = None
+        self._session_checks = collections.deque()
+        self._discovered = collections.deque()
+        self._last_beat = None
+        self._health = health.HealthRegistry()
+        self._speaker_labels = []
+        self._watchdog = lagwatch.Watchdog(LAG_INTERVAL / 1000.0,
+                                           STALL_THRESHOLD / 1000.0,
+                                           keep = STALLS_KEPT)
+
         self.create_widgets()
         self._create_menu()
 
@@ -97,14 +183,29 @@ class SonosList(tk.PanedWindow):
         self.rowconfigure(0, weight = 1)
         self.columnconfigure(0, weight = 1)
 
-        self._load_settings()
+        # Start beating before loading settings, the scan and its dialogs
+        # are exactly what the watchdog should catch.
+        self._watchdog.start()
+        self._heartbeat()
+
+        warm = self._load_settings()
         self._update_buttons()
-        self.set_now_playing_info()
+        if warm:
+            # The snapshot is on show, the window comes up before the
+            # speaker is asked for anything
+            self.__parent.after(1000, self.set_now_playing_info)
+        else:
+            self.set_now_playing_info()
+        self.__parent.after(SESSION_SAVE_INTERVAL, self._save_session_periodically)
 
     def destroy(self):
         try:
+            self._watchdog.stop()
+            self._art_loader.shutdown()
+            if self._recorder is not None:
+                self._recorder.close()
             del self.__list_content[:]
-            del self.__queue_content[:]
+            self.__queue_content.clear()
             if self.__current_speaker:
                 del self.__current_speaker
                 self.__current_speaker = None
@@ -121,14 +222,116 @@ class SonosList(tk.PanedWindow):
         self.destroy()
 
     def scan_speakers(self):
-        speakers = soco.discover()
+        speakers = self._discover_speakers()
         if not speakers:
             return logging.debug("No speakers found")
-        speakers = list(speakers)
-        logging.debug('Found %d speaker(s)', len(speakers))
-        [s.get_speaker_info() for s in speakers]
         self.add_speakers(speakers)
 
+    def _discover_speakers(self):
+        # Doesn't touch the widgets, the rediscovery after a warm start runs
+        # it on its thread
+        with perf.recorder.span('soco.discover'):
+            speakers = self._discover()
+        if not speakers:
+            return []
+        # discover() hands back a set, the order of the list (and of the
+        # calls below) should not change between runs
+        speakers = sorted(speakers, key = lambda speaker: speaker.ip_address)
+        logging.debug('Found %d speaker(s)', len(speakers))
+        for speaker in speakers:
+            try:
+                self._speaker_call(speaker, 'get_speaker_info')
+            except:
+                logging.error('Could not get speaker info from %s', speaker.ip_address)
+                logging.error(traceback.format_exc())
+        return speakers
+
+    def _speaker_call(self, speaker, method, *args, **kwargs):
+        # Every call to a speaker goes through here. Properties (volume) are
+        # read without arguments and assigned with one.
+        with perf.recorder.span('soco.' + method), \
+             metrics.registry.speaker_call(method,
+                                           speaker.ip_address,
+                                           speaker.speaker_info.get('zone_name')):
+            return self._health.call(speaker.ip_address,
+                                     self._invoke,
+                                     speaker,
+                                     method,
+                                     *args,
+                                     **kwargs)
+
+    def __invoke(self, speaker, method, *args, **kwargs):
+        # Dotted names reach into the speaker's services and helpers, e.g.
+        # 'music_library.get_music_library_information'
+        target = speaker
+        path = method.split('.')
+        for name in path[:-1]:
+            target = getattr(target, name)
+        method = path[-1]
+
+        if isinstance(getattr(type(target), method, None), property):
+            if args:
+                return setattr(target, method, args[0])
+            return getattr(target, method)
+        return getattr(target, method)(*args, **kwargs)
+
+    def _speaker_label(self, speaker):
+        # Uses the cached speaker info, str(speaker) asks the speaker for
+        # its name every time.
+        name = speaker.speaker_info.get('zone_name') or speaker.ip_address
+        label = "{} (\"{}\")".format(name, speaker.ip_address).title()
+
+        state = self._health.get(speaker.ip_address).describe()
+        if state:
+            label = '{} [{}]'.format(label, state)
+        return label
+
+    def _refresh_speaker_health(self):
+        with perf.recorder.span('ui.speaker_health'):
+            self.__refresh_speaker_health()
+
+    def __refresh_speaker_health(self):
+        selection = self._listbox.curselection()
+        for index, speaker in enumerate(self.__list_content):
+            label = self._speaker_label(speaker)
+            if index < len(self._speaker_labels) and \
+               self._speaker_labels[index] == label:
+                continue
+
+            self._listbox.delete(index)
+            self._listbox.insert(index, label)
+            if index in selection:
+                self._listbox.selection_set(index)
+
+            speaker_health = self._health.get(speaker.ip_address)
+            if speaker_health.state != health.CLOSED:
+                colour = 'red'
+            elif speaker_health.degraded():
+                colour = 'orange'
+            else:
+                colour = ''
+            self._listbox.itemconfig(index, foreground = colour)
+
+            if index < len(self._speaker_labels):
+                self._speaker_labels[index] = label
+            else:
+                self._speaker_labels.append(label)
+
+    def _heartbeat(self):
+        now = time.perf_counter()
+        if self._last_beat is not None:
+            lag = now - self._last_beat - LAG_INTERVAL / 1000.0
+            perf.recorder.record('ui.loop_lag', max(lag, 0.0))
+            if lag * 1000.0 > LAG_THRESHOLD:
+                perf.recorder.count('ui.loop_lag.late')
+        self._last_beat = now
+
+        stall = self._watchdog.beat()
+        if stall is not None:
+            perf.recorder.count('ui.stalls')
+            perf.recorder.record('ui.stall', stall.duration)
+        self.__parent.after(LAG_INTERVAL, self._heartbeat)
+
     def clean_exit(self):
         try:
             geometry = self.__parent.geometry()
@@ -147,6 +350,8 @@ class SonosList(tk.PanedWindow):
             finalSashValue = ','.join(sashes)
             logging.debug('Storing sashes: "%s"', finalSashValue)
             self.__set_config('sash_coordinates', finalSashValue)
+
+            self._save_session()
                 
         except:
             logging.error('Error making clean exit')
@@ -161,15 +366,17 @@ class SonosList(tk.PanedWindow):
         self._listbox.delete(0, tk.END)
         del self.__list_content[:]
         self.__list_content = []
+        self._speaker_labels = []
 
         if not speakers:
             logging.debug('No speakers to add, returning')
             return
         
         logging.debug('Inserting new items (%d)', len(speakers))
-        for speaker in speakers:
-            self.__list_content.append(speaker)
-            self._listbox.insert(tk.END, speaker)
+        with perf.recorder.span('ui.speaker_list'):
+            for speaker in speakers:
+                self.__list_content.append(speaker)
+            self._refresh_speaker_health()
         
     def create_widgets(self):
         logging.debug('Creating widgets')
@@ -199,6 +406,20 @@ class SonosList(tk.PanedWindow):
                            sticky = 'news')
 
 
+        # Create queue filter
+        self._queue_filter = tk.StringVar()
+        filter_entry = tk.Entry(self._right,
+                                textvariable = self._queue_filter)
+        # Typing, pasting and set() all end up here
+        self._queue_filter.trace('w', self._queue_filter_changed)
+
+        filter_entry.grid(row = 0,
+                          column = 0,
+                          columnspan = 2,
+                          padx = 5,
+                          pady = 5,
+                          sticky = 'we')
+
         # Create queue list
         scrollbar = tk.Scrollbar(self._right)
         self._queuebox = tk.Listbox(self._right,
@@ -208,12 +429,12 @@ class SonosList(tk.PanedWindow):
         self._queuebox.config(yscrollcommand = scrollbar.set)
         self._queuebox.bind('<Double-Button-1>', self._play_selected_queue_item)
         
-        scrollbar.grid(row = 0,
+        scrollbar.grid(row = 1,
                        column = 1,
                        pady = 5,
                        sticky = 'ns')
         
-        self._queuebox.grid(row = 0,
+        self._queuebox.grid(row = 1,
                             column = 0,
                             padx = 5,
                             pady = 5,
@@ -227,7 +448,7 @@ class SonosList(tk.PanedWindow):
         self._center.rowconfigure(0, weight = 1)
         self._center.columnconfigure(0, weight = 1)
 
-        self._right.rowconfigure(0, weight = 1)
+        self._right.rowconfigure(1, weight = 1)
         self._right.columnconfigure(0, weight = 1)
 
         self._info = tk.Frame(self._center)
@@ -421,7 +642,7 @@ class SonosList(tk.PanedWindow):
         if not selection:
             return None, None
 
-        index = int(selection[0])
+        index = self.__queue_position(int(selection[0]))
 
         assert len(self.__queue_content) > index
         track = self.__queue_content[index]
@@ -437,16 +658,19 @@ class SonosList(tk.PanedWindow):
         volume = self.now_playing_widget['volume'].get()
 
         logging.debug('Changing volume to: %d', volume)
-        speaker.volume(volume)
+        self._speaker_call(speaker, 'volume', volume)
 
     def clear(self, type_name):
         if type_name == 'queue':
             logging.debug('Deleting old items')
             self._queuebox.delete(0, tk.END)
-            del self.__queue_content[:]
-            self.__queue_content = []
+            self.__queue_content.clear()
+            self.__queue_speaker = None
+            self.__queue_view = None
         elif type_name == 'album_art':
-            self.now_playing_widget[type_name].config(image = None)
+            self._art_url = None
+            self.now_playing_widget[type_name].config(image = '')
+            self.now_playing_widget[type_name].image = None
         
     def _listbox_selected(self, evt):
         # Note here that Tkinter passes an event object to onselect()
@@ -469,14 +693,31 @@ class SonosList(tk.PanedWindow):
         
         self.show_speaker_info(speaker)
         self._update_buttons()
+        self._refresh_speaker_health()
                 
-        logging.debug('Zoneplayer: "%s"', speaker)
+        logging.debug('Zoneplayer: "%s"', speaker.ip_address)
 
-        logging.debug('Storing last_selected: %s' % speaker.speaker_info['uid'])
-        self.__set_config('last_selected', speaker.speaker_info['uid'])
+        # Speakers whose info could not be fetched have no uid to store
+        uid = speaker.speaker_info.get('uid')
+        if uid:
+            logging.debug('Storing last_selected: %s' % uid)
+            self.__set_config('last_selected', uid)
+            if self._recorder is not None:
+                self._recorder.note('selected', uid)
 
     def set_now_playing_info(self):
-        self.__set_now_playing_info()
+        try:
+            self.__set_now_playing_info()
+        except health.SpeakerUnavailable:
+            pass
+        except OSError:
+            logging.warning('Could not update now playing info: %s',
+                            traceback.format_exc().splitlines()[-1])
+        except:
+            logging.error('Could not update now playing info')
+            logging.error(traceback.format_exc())
+
+        self._refresh_speaker_health()
         logging.debug("Tick.")
         self.__parent.after(1000, self.set_now_playing_info)
 
@@ -486,17 +727,36 @@ class SonosList(tk.PanedWindow):
             self.set_now_playing_info_from_speaker(speaker)
 
     def set_now_playing_info_from_speaker(self, speaker):
-        track = speaker.get_current_track_info()
+        track = self._speaker_call(speaker, 'get_current_track_info')
+        track['volume'] = self._speaker_call(speaker, 'volume')
+        self._show_track(track)
+
+        logging.info("Set track info")
+        return track
+
+    def _show_track(self, track):
+        self._last_track = track
         BASIC_DATA = ("title", "artist", "album")
-        playing_track = track['uri']
-        track['volume'] = speaker.volume
+        playing_track = track.get('uri')
+
+        duration = track.get("duration", "0:00:0")
+        position = track.get("position", "0:00:0")
+        duration = parse_time(duration)
+        position = parse_time(position)
+        volume = track.get("volume")
+
+        # One span per update, album art is timed on its own
+        with perf.recorder.span('ui.now_playing'):
+            for key in BASIC_DATA:
+                label = self.now_playing_widget[key]
+                text = track.get(key) if track.get(key) else self.empty_info
+                label.config(text=text)
 
-        for key in BASIC_DATA:
-            label = self.now_playing_widget[key]
-            text = track.get(key) if track.get(key) else self.empty_info
-            label.config(text=text)
+            if volume:
+                self.now_playing_widget["volume"].set(volume)
 
-        self.clear('album_art')
+            self.now_playing_widget["duration"].config(text=duration)
+            self.now_playing_widget["position"].config(text=position)
 
         art = track.get("album_art")
         if art:
@@ -504,24 +764,9 @@ class SonosList(tk.PanedWindow):
         else:
             self.set_album_art(None)
 
-        volume = track.get("volume")
-        if volume:
-            self.now_playing_widget["volume"].set(volume)
-
-        duration = track.get("duration", "0:00:0")
-        position = track.get("position", "0:00:0")
-        duration = parse_time(duration)
-        position = parse_time(position)
-        self.now_playing_widget["duration"].config(text=duration)
-        self.now_playing_widget["position"].config(text=position)
-
-        logging.info("Set track info")
-        
-
-    def show_speaker_info(self, speaker, refresh_queue=None):
-        refresh_queue = True
+    def show_speaker_info(self, speaker, refresh_queue=True):
         if speaker is not None and (
-            not isinstance(speaker, soco.SoCo)):
+            not isinstance(speaker, (soco.SoCo, replay.ReplaySpeaker))):
             raise TypeError('Unsupported type: %s', type(speaker))
 
         self.__current_speaker = speaker
@@ -547,8 +792,17 @@ class SonosList(tk.PanedWindow):
         #######################
         playing_track = None
         try:
-            logging.info('Receive speaker info from: "%s"' % speaker)
-            self.set_now_playing_info_from_speaker(speaker)
+            logging.info('Receive speaker info from: "%s"' % speaker.ip_address)
+            track = self.set_now_playing_info_from_speaker(speaker)
+            playing_track = track.get('uri')
+        except OSError:
+            # Unreachable speakers are flagged in the speaker list instead
+            logging.warning('Could not receive speaker information: %s',
+                            traceback.format_exc().splitlines()[-1])
+        except replay.ReplayMissing:
+            # No dialog, replays run unattended
+            logging.error('Speaker information not in recording: %s',
+                          traceback.format_exc().splitlines()[-1])
         except:
             errmsg = traceback.format_exc()
             logging.error(errmsg)
@@ -559,28 +813,22 @@ class SonosList(tk.PanedWindow):
         # Load queue
         #######################
         try:
-            select = None
             if refresh_queue:
-                logging.debug('Gettting queue from speaker')
-                queue = speaker.get_queue()
-
-                logging.debug('Deleting old items')
-                self.clear('queue')
-
-                logging.debug('Inserting items (%d) to listbox', len(queue))
-                for index, item in enumerate(queue):
-                    string = self.label_queue.format(item.creator, item.title)
-                    self.__queue_content.append(item)
-                    self._queuebox.insert(tk.END, string)
+                self._load_queue(speaker)
 
             if playing_track is not None:
-                for index, item in enumerate(self.__queue_content):
-                    if item.resources[0].uri == playing_track:
-                        self._queuebox.selection_clear(0, tk.END)
-                        self._queuebox.selection_anchor(index)
-                        self._queuebox.selection_set(index)
-                        break
+                index = self.__queue_row(self.__queue_content.find_uri(playing_track))
+                if index is not None:
+                    self._queuebox.selection_clear(0, tk.END)
+                    self._queuebox.selection_anchor(index)
+                    self._queuebox.selection_set(index)
                 
+        except OSError:
+            logging.warning('Could not receive speaker queue: %s',
+                            traceback.format_exc().splitlines()[-1])
+        except replay.ReplayMissing:
+            logging.error('Speaker queue not in recording: %s',
+                          traceback.format_exc().splitlines()[-1])
         except:
             errmsg = traceback.format_exc()
             logging.error(errmsg)
@@ -588,34 +836,147 @@ class SonosList(tk.PanedWindow):
                                    message = 'Could not receive speaker queue')
 
 
-    def get_album_art_from_database(self, url):
+    def _load_queue(self, speaker):
+        try:
+            queue = self._fetch_queue(speaker)
+        except:
+            # The queue shown stays when it is this speaker's, another
+            # speaker's must not be taken for it
+            if self.__queue_speaker is not speaker:
+                self.clear('queue')
+            raise
+        self._set_queue(speaker, queue)
+
+    def _fetch_queue(self, speaker):
+        # Pages are packed into the compact queue right away, so only the
+        # DIDL objects of one page are alive at a time. Doesn't touch the
+        # widgets, the session check runs it on its thread.
+        logging.debug('Gettting queue from speaker')
+        queue = queue_model.CompactQueue()
+        while True:
+            page = self._speaker_call(speaker, 'get_queue', len(queue), QUEUE_PAGE)
+            queue.extend(page)
+            queue.update_id = getattr(page, 'update_id', None)
+
+            total = getattr(page, 'total_matches', None)
+            if not page or total is None or len(queue) >= total:
+                break
+        return queue
+
+    def _set_queue(self, speaker, queue):
+        # Only complete queues get here, a failed load leaves the one shown
+        self.__queue_content = queue
+        self.__queue_speaker = speaker
+        self._show_queue()
+
+    def _select_queue_uri(self, uri):
+        index = self.__queue_row(self.__queue_content.find_uri(uri))
+        if index is not None:
+            self._queuebox.selection_clear(0, tk.END)
+            self._queuebox.selection_set(index)
+            self._queuebox.see(index)
+
+    def _show_queue(self):
+        queue = self.__queue_content
+        self._shown_filter = self._queue_filter.get()
+        with perf.recorder.span('queue.search'):
+            self.__queue_view = queue.search(self._shown_filter)
+
+        positions = self.__queue_view
+        if positions is None:
+            positions = range(len(queue))
+
+        logging.debug('Inserting items (%d) to listbox', len(positions))
+        with perf.recorder.span('ui.queue'):
+            self._queuebox.delete(0, tk.END)
+            labels = [queue.label(index, self.label_queue)
+                      for index in positions]
+            if labels:
+                self._queuebox.insert(tk.END, *labels)
+
+    def _queue_filter_changed(self, *args):
+        if self._queue_filter.get() != self._shown_filter:
+            self._show_queue()
+
+    def __queue_position(self, row):
+        # Listbox row to position in the speaker queue
+        if self.__queue_view is None:
+            return row
+        return self.__queue_view[row]
+
+    def __queue_row(self, position):
+        if position is None or self.__queue_view is None:
+            return position
+        row = bisect.bisect_left(self.__queue_view, position)
+        if row < len(self.__queue_view) and self.__queue_view[row] == position:
+            return row
+        return None
+
+    def get_album_art_hash(self, url):
         if not self._connection:
             logging.error("No database connection to get art from.")
             return None
         elif not url:
             logging.error("No URI to query.")
             return None
-        c = self._connection.cursor()
-        c.execute("SELECT * FROM images where uri=?", (url,))
-        top_res = c.fetchone()
-        if top_res:
-            data = BytesIO(top_res[1])
-            data.seek(0)
-            return data
-        return None
+        with perf.recorder.span('db.get_album_art'), \
+             clib.closing(self._connection.execute(
+                 'SELECT hash FROM art_urls WHERE uri = ?', (url, ))) as cur:
+            row = cur.fetchone()
+        return row['hash'] if row else None
 
-    def set_album_art_in_database(self, url, data):
+    def get_album_art_from_database(self, digest):
+        with perf.recorder.span('db.get_album_art'), \
+             clib.closing(self._connection.execute(
+                 'SELECT image FROM art_blobs WHERE hash = ?', (digest, ))) as cur:
+            row = cur.fetchone()
+        return bytes(row['image']) if row else None
+
+    def has_album_art_in_database(self, digest):
+        with perf.recorder.span('db.get_album_art'), \
+             clib.closing(self._connection.execute(
+                 'SELECT 1 FROM art_blobs WHERE hash = ?', (digest, ))) as cur:
+            return cur.fetchone() is not None
+
+    def get_album_art_thumb(self, digest, size):
+        with perf.recorder.span('db.get_album_art'), \
+             clib.closing(self._connection.execute(
+                 '''SELECT mode, thumb_width, thumb_height, pixels FROM art_thumbs
+                    WHERE hash = ? AND width = ? AND height = ?''',
+                 (digest, size[0], size[1]))) as cur:
+            row = cur.fetchone()
+        if not row:
+            return None
+        return (row['mode'],
+                (row['thumb_width'], row['thumb_height']),
+                zlib.decompress(row['pixels']))
+
+    def set_album_art_in_database(self, url, digest, data):
         if not self._connection:
             logging.error("No database connection to get art from.")
             return None
         elif not url or not data:
             logging.error("No URI or data to insert.")
             return None
-        c = self._connection.cursor()
-        c.execute("INSERT INTO images VALUES (?, ?)",(url, sql.Binary(data)))
-        self._connection.commit()
-
-                
+        with perf.recorder.span('db.set_album_art'):
+            self._connection.execute(
+                'INSERT OR REPLACE INTO art_urls (uri, hash) VALUES (?, ?)',
+                (url, digest)).close()
+            self._connection.execute(
+                'INSERT OR IGNORE INTO art_blobs (hash, image) VALUES (?, ?)',
+                (digest, sql.Binary(data))).close()
+            self._connection.commit()
+
+    def set_album_art_thumb(self, digest, size, thumb):
+        mode, thumb_size, pixels = thumb
+        with perf.recorder.span('db.set_album_art'):
+            self._connection.execute(
+                '''INSERT OR REPLACE INTO art_thumbs
+                   (hash, width, height, mode, thumb_width, thumb_height, pixels)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (digest, size[0], size[1], mode, thumb_size[0], thumb_size[1],
+                 sql.Binary(zlib.compress(pixels)))).close()
+            self._connection.commit()
 
     def set_album_art(self, url, track_uri=None):
         if ImageTk is None:
@@ -623,38 +984,109 @@ class SonosList(tk.PanedWindow):
             return
 
         if not url:
-            self.now_playing_widget['album_art'].config(image=None)
-            self.now_playing_widget['album_art'].image = None
-            logging.warning('url is empty, returning')
+            if self._art_url is not None:
+                logging.debug('url is empty, clearing album art')
+                self.clear('album_art')
             return
-        raw_data = None
-        # Receive Album art, resize it and show it
+
+        # Called every tick, the art is already shown or on its way
+        if url == self._art_url:
+            return
+        self._art_url = url
+
+        # Receive Album art, resize it and show it. A thumbnail stored for the
+        # same content is shown right away, otherwise the art loader fetches
+        # and decodes and _poll_album_art picks up the result.
         try:
-            raw_data = self.get_album_art_from_database(url)
-
-            if raw_data is None:
-                resp = requests.get(url)
-                logging.info('Could not find cached album art, loading from URL')
-                raw_data = BytesIO(resp.content)
-                raw_data.seek(0)
-
-            image = Image.open(raw_data)
-            widgetConfig = self.now_playing_widget['album_art'].config()
-            thumbSize = (int(widgetConfig['width'][4]),
-                         int(widgetConfig['height'][4]))
-
-            logging.debug('Resizing album art to: %s', thumbSize)
-            image.thumbnail(thumbSize,
-                            Image.ANTIALIAS)
-            newImage = ImageTk.PhotoImage(image = image)
-            self.set_album_art_in_database(url, raw_data)
-            self.now_playing_widget['album_art'].config(image = newImage)
-            self.now_playing_widget['album_art'].image = newImage # W/o a ref, TK drops the image.
+            digest = self.get_album_art_hash(url)
+            if digest is None:
+                perf.recorder.count('art.cache.miss')
+                self.__art_pending(url, self._art_loader.fetch(url), self.__art_fetched)
+            else:
+                perf.recorder.count('art.cache.hit')
+                self.__art_stored(url, digest)
         except:
             logging.error('Could not set album art, skipping...')
             logging.error(url)
             logging.error(traceback.format_exc())
 
+    def __art_size(self):
+        widgetConfig = self.now_playing_widget['album_art'].config()
+        return (int(widgetConfig['width'][4]),
+                int(widgetConfig['height'][4]))
+
+    def __art_pending(self, url, future, done):
+        self._art_pending.append((url, future, done))
+        if not self._art_polling:
+            self._art_polling = True
+            self.__parent.after(ART_POLL, self._poll_album_art)
+
+    def __art_fetched(self, url, result):
+        data, digest = result
+        known = self.has_album_art_in_database(digest)
+        if known:
+            # Same image as another URL, only the mapping is new
+            perf.recorder.count('art.dedup')
+        self.set_album_art_in_database(url, digest, data)
+        self.__art_stored(url, digest, None if known else data)
+
+    def __art_stored(self, url, digest, data = None):
+        size = self.__art_size()
+        thumb = self.get_album_art_thumb(digest, size)
+        if thumb is not None:
+            self.__show_album_art(thumb)
+            return
+
+        if data is None:
+            data = self.get_album_art_from_database(digest)
+
+        logging.debug('Resizing album art to: %s', size)
+        self.__art_pending(url,
+                           self._art_loader.decode(data, size),
+                           lambda url, thumb: self.__art_decoded(digest, size, thumb))
+
+    def __art_decoded(self, digest, size, thumb):
+        self.set_album_art_thumb(digest, size, thumb)
+        self.__show_album_art(thumb)
+
+    def __show_album_art(self, thumb):
+        mode, size, pixels = thumb
+        with perf.recorder.span('ui.album_art'):
+            image = Image.frombytes(mode, size, pixels)
+            newImage = ImageTk.PhotoImage(image = image)
+            self.now_playing_widget['album_art'].config(image = newImage)
+            self.now_playing_widget['album_art'].image = newImage # W/o a ref, TK drops the image.
+
+    def _poll_album_art(self):
+        current, self._art_pending = self._art_pending, []
+        pending = []
+        for url, future, done in current:
+            if not future.done():
+                pending.append((url, future, done))
+                continue
+
+            if url != self._art_url:
+                # The track changed while this one was loading
+                perf.recorder.count('art.stale')
+                continue
+
+            try:
+                done(url, future.result())
+            except:
+                logging.error('Could not set album art, skipping...')
+                logging.error(url)
+                logging.error(traceback.format_exc())
+                # Keeps _art_url, so a broken image isn't retried every tick
+                self.now_playing_widget['album_art'].config(image = '')
+                self.now_playing_widget['album_art'].image = None
+
+        # Callbacks may have queued the next step
+        self._art_pending = pending + self._art_pending
+        if self._art_pending:
+            self.__parent.after(ART_POLL, self._poll_album_art)
+        else:
+            self._art_polling = False
+
     def _update_buttons(self):
         logging.debug('Updating control buttons')
         speaker = self.get_selected_speaker()
@@ -716,6 +1148,20 @@ class SonosList(tk.PanedWindow):
         self._control_buttons['next'] = button_next
         buttonIndex += 1
 
+    def browse_library(self):
+        if self._library_browser is not None and \
+           self._library_browser.winfo_exists():
+            self._library_browser.lift()
+            return
+
+        speaker = self.get_selected_speaker()
+        if speaker is None:
+            messagebox.showinfo(title = 'Library...',
+                                message = 'Select a speaker to browse its library')
+            return
+
+        self._library_browser = LibraryBrowser(self.__parent, self, speaker)
+
     def _create_menu(self):
         logging.debug('Creating menu')
         self._menubar = tk.Menu(self)
@@ -727,6 +1173,9 @@ class SonosList(tk.PanedWindow):
 
         self._filemenu.add_command(label="Scan for speakers",
                                    command=self.scan_speakers)
+
+        self._filemenu.add_command(label="Browse library",
+                                   command=self.browse_library)
         
         self._filemenu.add_command(label="Exit",
                                    command=self.clean_exit)
@@ -747,6 +1196,214 @@ class SonosList(tk.PanedWindow):
         self._playbackmenu.add_command(label = "Next",
                                        command = self.__next)
 
+        # Queue menu, also shown on right click in the queue
+        self._queuemenu = tk.Menu(self._menubar, tearoff=0)
+        self._menubar.add_cascade(label="Queue", menu=self._queuemenu)
+
+        self._queuemenu.add_command(label = "Remove selected",
+                                    command = self.remove_selected_queue_items)
+
+        self._queuemenu.add_separator()
+
+        for label, where in (("Move to top", 'top'),
+                             ("Move up", 'up'),
+                             ("Move down", 'down'),
+                             ("Move to bottom", 'bottom')):
+            self._queuemenu.add_command(
+                label = label,
+                command = lambda where = where: self.move_selected_queue_items(where))
+
+        self._queuebox.bind('<Button-3>', self._show_queue_menu)
+        self._queuebox.bind('<Delete>', self.remove_selected_queue_items)
+
+        # Debug menu
+        self._debugmenu = tk.Menu(self._menubar, tearoff=0)
+        self._menubar.add_cascade(label="Debug", menu=self._debugmenu)
+
+        self._perf_enabled = tk.BooleanVar(value = perf.recorder.enabled)
+        self._debugmenu.add_checkbutton(label = "Record timings",
+                                        variable = self._perf_enabled,
+                                        command = self._toggle_perf)
+
+        self._perf_overlay_shown = tk.BooleanVar(value = False)
+        self._debugmenu.add_checkbutton(label = "Performance overlay",
+                                        variable = self._perf_overlay_shown,
+                                        command = self._toggle_perf_overlay)
+
+        self._debugmenu.add_command(label = "Dump performance report",
+                                    command = self._dump_perf)
+
+        self._debugmenu.add_command(label = "Reset timings",
+                                    command = perf.recorder.reset)
+
+    def _toggle_perf(self):
+        perf.recorder.enabled = self._perf_enabled.get()
+        logging.info('Performance recording: %s', perf.recorder.enabled)
+
+    def _toggle_perf_overlay(self):
+        if not self._perf_overlay_shown.get():
+            if self._perf_refresh is not None:
+                self.__parent.after_cancel(self._perf_refresh)
+                self._perf_refresh = None
+            if self._perf_overlay is not None:
+                self._perf_overlay.destroy()
+                self._perf_overlay = None
+            return
+
+        # Showing the overlay without data would be pointless
+        self._perf_enabled.set(True)
+        self._toggle_perf()
+
+        self._perf_overlay = tk.Toplevel(self.__parent)
+        self._perf_overlay.wm_title('Performance')
+        self._perf_overlay.attributes('-topmost', True)
+        self._perf_overlay.protocol('WM_DELETE_WINDOW', self._close_perf_overlay)
+
+        text = tk.Text(self._perf_overlay,
+                       width = 80,
+                       height = 24,
+                       font = 'TkFixedFont')
+        text.grid(row = 0,
+                  column = 0,
+                  sticky = 'news')
+        self._perf_overlay.rowconfigure(0, weight = 1)
+        self._perf_overlay.columnconfigure(0, weight = 1)
+        self._perf_overlay.text = text
+
+        self._refresh_perf_overlay()
+
+    def _close_perf_overlay(self):
+        self._perf_overlay_shown.set(False)
+        self._toggle_perf_overlay()
+
+    def _refresh_perf_overlay(self):
+        self._perf_refresh = None
+        if self._perf_overlay is None:
+            return
+
+        text = self._perf_overlay.text
+        text.config(state = tk.NORMAL)
+        text.delete('1.0', tk.END)
+        text.insert(tk.END, perf.recorder.report())
+        text.insert(tk.END, '\n\n')
+        text.insert(tk.END, self._watchdog.report(stacks = False))
+        text.config(state = tk.DISABLED)
+        self._perf_refresh = self.__parent.after(1000, self._refresh_perf_overlay)
+
+    def _dump_perf(self):
+        path = os.path.join(USER_DATA,
+                            time.strftime('perf-%Y%m%d-%H%M%S.txt'))
+        try:
+            perf.recorder.dump(path)
+            with open(path, 'a') as handle:
+                handle.write('\n')
+                handle.write(self._watchdog.report())
+                handle.write('\n')
+        except:
+            logging.error('Could not write performance report')
+            logging.error(traceback.format_exc())
+            return
+
+        messagebox.showinfo(title = 'Performance...',
+                            message = 'Report written to: {}'.format(path))
+
+
+    def get_selected_queue_positions(self):
+        return [self.__queue_position(int(row))
+                for row in self._queuebox.curselection()]
+
+    def remove_selected_queue_items(self, evt = None):
+        speaker = self.get_selected_speaker()
+        positions = self.get_selected_queue_positions()
+        if speaker is None or not positions:
+            return
+
+        try:
+            # Last range first, so the start of the others stays valid
+            for start, count in reversed(queue_model.runs(positions)):
+                self._speaker_call(speaker,
+                                   'avTransport.RemoveTrackRangeFromQueue',
+                                   [('InstanceID', 0),
+                                    ('UpdateID', 0),
+                                    ('StartingIndex', start + 1),
+                                    ('NumberOfTracks', count)])
+        except:
+            self.__queue_edit_failed(speaker, 'remove')
+            return
+
+        self.__queue_content.remove(positions)
+        self._show_queue()
+
+    def move_selected_queue_items(self, where):
+        speaker = self.get_selected_speaker()
+        positions = self.get_selected_queue_positions()
+        if speaker is None or not positions:
+            return
+
+        queue = self.__queue_content
+        insert_before = {'top': 0,
+                         'up': max(min(positions) - 1, 0),
+                         'down': min(max(positions) + 2, len(queue)),
+                         'bottom': len(queue)}[where]
+
+        order = queue_model.move_order(len(queue), positions, insert_before)
+        keys = [queue.key(position) for position in positions]
+        try:
+            for start, count, before in queue_model.reorder_ops(order):
+                self._speaker_call(speaker,
+                                   'avTransport.ReorderTracksInQueue',
+                                   [('InstanceID', 0),
+                                    ('StartingIndex', start + 1),
+                                    ('NumberOfTracks', count),
+                                    ('InsertBefore', before + 1),
+                                    ('UpdateID', 0)])
+        except:
+            self.__queue_edit_failed(speaker, 'move')
+            return
+
+        queue.reorder(order)
+        self._show_queue()
+
+        for key in keys:
+            row = self.__queue_row(queue.position(key))
+            if row is not None:
+                self._queuebox.selection_set(row)
+
+    def add_to_queue(self, items):
+        speaker = self.get_selected_speaker()
+        if speaker is None or not items:
+            return
+
+        try:
+            # Sent 16 items per request
+            self._speaker_call(speaker, 'add_multiple_to_queue', items)
+        except:
+            self.__queue_edit_failed(speaker, 'add')
+            return
+
+        # Containers (albums, playlists...) get expanded by the speaker
+        if all(item.item_class.startswith('object.item') for item in items):
+            self.__queue_content.extend(items)
+            self._show_queue()
+        else:
+            self._load_queue(speaker)
+
+    def __queue_edit_failed(self, speaker, action):
+        logging.error('Could not %s queue items', action)
+        logging.error(traceback.format_exc())
+
+        # Part of the edit may have been made, start over from the speaker
+        try:
+            self._load_queue(speaker)
+        except:
+            logging.error('Could not reload queue')
+            logging.error(traceback.format_exc())
+
+        messagebox.showerror(title = 'Queue...',
+                             message = 'Could not {} queue items, please check error log for description'.format(action))
+
+    def _show_queue_menu(self, evt):
+        self._queuemenu.tk_popup(evt.x_root, evt.y_root)
 
     def _play_selected_queue_item(self, evt):
         try:
@@ -758,7 +1415,7 @@ class SonosList(tk.PanedWindow):
                 logging.warning('Could not get track or speaker (%s, %s)', track_index, speaker)
                 return
             
-            speaker.play_from_queue(track_index)
+            self._speaker_call(speaker, 'play_from_queue', track_index)
             self.show_speaker_info(speaker, refresh_queue = False)
         except:
             logging.error('Could not play queue item')
@@ -767,46 +1424,45 @@ class SonosList(tk.PanedWindow):
                                    message = 'Error playing queue item, please check error log for description')
         
 
-    def __previous(self):
+    def __control(self, action):
         speaker = self.get_selected_speaker()
         if not speaker:
             raise SystemError('No speaker selected, this should not happend')
 
-        speaker.previous()
+        try:
+            self._speaker_call(speaker, action)
+        except OSError:
+            logging.warning('Could not %s on "%s": %s',
+                            action,
+                            speaker.ip_address,
+                            traceback.format_exc().splitlines()[-1])
+            self._refresh_speaker_health()
+            return
+
         self.show_speaker_info(speaker, refresh_queue = False)
+
+    def __previous(self):
+        self.__control('previous')
         
     def __next(self):
-        speaker = self.get_selected_speaker()
-        if not speaker:
-            raise SystemError('No speaker selected, this should not happend')
-
-        speaker.next()
-        self.show_speaker_info(speaker, refresh_queue = False)
+        self.__control('next')
 
     def __pause(self):
-        speaker = self.get_selected_speaker()
-        if not speaker:
-            raise SystemError('No speaker selected, this should not happend')
-
-        speaker.pause()
-        self.show_speaker_info(speaker, refresh_queue = False)
+        self.__control('pause')
 
     def __play(self):
-        speaker = self.get_selected_speaker()
-        if not speaker:
-            raise SystemError('No speaker selected, this should not happend')
-
-        speaker.play()
-        self.show_speaker_info(speaker, refresh_queue = False)
+        self.__control('play')
 
     def _load_settings(self):
-        # Connect to database
+        # Connect to database. Recording and replaying start from an empty
+        # one, so every run does the same work (no cached art or library)
+        # and the real settings and session are left alone.
         self.dbPath = os.path.join(USER_DATA, 'SoCo-Tk.sqlite')
+        if self._recorder is not None or self._player is not None:
+            self.dbPath = ':memory:'
 
-        create_structure = False
-        if not os.path.exists(self.dbPath):
+        if self.dbPath != ':memory:' and not os.path.exists(self.dbPath):
             logging.info('Database "%s" not found, creating', self.dbPath)
-            create_structure = True
 
             if not os.path.exists(USER_DATA):
                 logging.info('Creating directory structure')
@@ -816,8 +1472,9 @@ class SonosList(tk.PanedWindow):
         self._connection = sql.connect(self.dbPath)
         self._connection.row_factory = sql.Row
 
-        if create_structure:
-            self._create_settings_database()
+        # Tables are created if missing, so older databases get the ones
+        # added since.
+        self._create_settings_database()
 
         # Load window geometry
         geometry = self.__get_config('window_geometry')
@@ -830,20 +1487,39 @@ class SonosList(tk.PanedWindow):
                 logging.error(traceback.format_exc())
 
 
-        message = 'Do you want to scan for speakers?'
-        
-        doscan = messagebox.askyesno(title = 'Scan...',
-                                       message = message)
-        if doscan: self.scan_speakers()
+        # Speakers of the last session are shown right away, without
+        # asking to scan. A replay only knows the recorded speakers, and a
+        # recording has to hold the discovery a replay starts with.
+        traffic = self._recorder is not None or self._player is not None
+        restored = None
+        if not traffic:
+            restored = self._restore_speakers()
 
-        # Load last selected speaker
-        selected_speaker_uid = self.__get_config('last_selected')
+        if traffic:
+            self.scan_speakers()
+        elif restored:
+            logging.info('Restoring %d speaker(s) from last session', len(restored))
+            self.add_speakers(restored)
+        else:
+            message = 'Do you want to scan for speakers?'
+            
+            doscan = messagebox.askyesno(title = 'Scan...',
+                                           message = message)
+            if doscan: self.scan_speakers()
+
+        # Load last selected speaker, a replay selects the one selected
+        # while recording
+        if self._player is not None:
+            selected_speaker_uid = self._player.note('selected')
+        else:
+            selected_speaker_uid = self.__get_config('last_selected')
         logging.debug('Last selected speaker: %s', selected_speaker_uid)
 
+        warm = False
         selectIndex = None
         selectSpeaker = None
         for index, speaker in enumerate(self.__list_content):
-            if speaker.speaker_info['uid'] == selected_speaker_uid:
+            if speaker.speaker_info.get('uid') == selected_speaker_uid:
                 selectIndex = index
                 selectSpeaker = speaker
                 break
@@ -852,22 +1528,249 @@ class SonosList(tk.PanedWindow):
             self._listbox.selection_anchor(selectIndex)
             self._listbox.selection_set(selectIndex)
             self._listbox.see(selectIndex)
-            self.show_speaker_info(speaker)      
+            if restored and self._show_snapshot(selectSpeaker):
+                self._check_session(selectSpeaker)
+                warm = True
+            else:
+                self.show_speaker_info(selectSpeaker)
+
+        if restored:
+            self._rediscover()
+        return warm
+
+    def _restore_speakers(self):
+        with perf.recorder.span('db.session'), \
+             clib.closing(self._connection.execute(
+                'SELECT * FROM speakers ORDER BY speaker_id')) as cur:
+            rows = cur.fetchall()
+
+        speakers = []
+        for row in rows:
+            # SoCo does not talk to the speaker until asked for something,
+            # the stored info saves the get_speaker_info round trip.
+            speaker = soco.SoCo(row['ip'])
+            if not speaker.speaker_info:
+                speaker.speaker_info = {'zone_name': row['name'],
+                                        'uid': row['uid'],
+                                        'serial_number': row['serial'],
+                                        'mac_address': row['mac']}
+            speakers.append(speaker)
+        return speakers
+
+    def _show_snapshot(self, speaker):
+        uid = speaker.speaker_info.get('uid')
+        with perf.recorder.span('db.session'), \
+             clib.closing(self._connection.execute(
+                'SELECT * FROM session_state WHERE uid = ?', (uid, ))) as cur:
+            row = cur.fetchone()
+        if row is None:
+            return False
+
+        logging.info('Showing last known state of "%s"', speaker.ip_address)
+        self.__current_speaker = speaker
+        self.now_playing_widget['volume'].config(state = tk.ACTIVE)
+
+        try:
+            track = json.loads(row['track']) if row['track'] else {}
+            self._show_track(track)
+
+            queue = queue_model.CompactQueue()
+            if row['queue']:
+                queue.load_bytes(row['queue'])
+                self._session_saved = (uid, queue.version)
+            self._set_queue(speaker, queue)
+            self._select_queue_uri(track.get('uri'))
+        except:
+            logging.error('Could not restore session of "%s"', speaker.ip_address)
+            logging.error(traceback.format_exc())
+            return False
+        return True
+
+    def _check_session(self, speaker):
+        # Asks the speaker shown for its queue update ID in the background,
+        # the queue is only fetched again (on the same thread) when it
+        # changed since the snapshot.
+        queue = self.__queue_content
+        update_id = queue.update_id
+        version = queue.version
+
+        def check():
+            changed = None
+            try:
+                page = self._speaker_call(speaker, 'get_queue', 0, 1)
+                if update_id is not None and \
+                   getattr(page, 'update_id', None) == update_id:
+                    logging.info('Queue of "%s" unchanged since last session',
+                                 speaker.ip_address)
+                else:
+                    logging.info('Queue of "%s" changed since last session, reloading',
+                                 speaker.ip_address)
+                    changed = self._fetch_queue(speaker)
+            except:
+                logging.warning('Could not check "%s": %s',
+                                speaker.ip_address,
+                                traceback.format_exc().splitlines()[-1])
+            self._session_checks.append((speaker, version, changed))
+
+        thread = threading.Thread(target = check, name = 'session-check')
+        thread.daemon = True
+        thread.start()
+        self.__parent.after(SESSION_POLL, self._poll_session_checks)
+
+    def _rediscover(self):
+        # Restored speakers may have moved to another address, and zones may
+        # have been added since the last session. Discovery runs in the
+        # background and the list is reconciled by uid.
+        def discover():
+            try:
+                self._discovered.append(self._discover_speakers())
+            except:
+                logging.warning('Could not discover speakers: %s',
+                                traceback.format_exc().splitlines()[-1])
+                self._discovered.append([])
+
+        thread = threading.Thread(target = discover, name = 'speaker-discovery')
+        thread.daemon = True
+        thread.start()
+        self.__parent.after(SESSION_POLL, self._poll_discovery)
+
+    def _poll_discovery(self):
+        if not self._discovered:
+            self.__parent.after(SESSION_POLL, self._poll_discovery)
+            return
+        self._merge_speakers(self._discovered.popleft())
+
+    def _merge_speakers(self, found):
+        fresh = {}
+        for speaker in found:
+            uid = speaker.speaker_info.get('uid')
+            if uid:
+                fresh[uid] = speaker
+            else:
+                logging.warning('Skipping speaker without info: %s', speaker.ip_address)
+
+        merged = []
+        changed = False
+        for speaker in self.__list_content:
+            found_speaker = fresh.pop(speaker.speaker_info.get('uid'), None)
+            if found_speaker is not None and found_speaker is not speaker:
+                logging.info('Speaker "%s" moved from %s to %s',
+                             speaker.speaker_info.get('zone_name'),
+                             speaker.ip_address,
+                             found_speaker.ip_address)
+                if speaker is self.__current_speaker:
+                    self.__current_speaker = found_speaker
+                if speaker is self.__queue_speaker:
+                    self.__queue_speaker = found_speaker
+                speaker = found_speaker
+                changed = True
+            merged.append(speaker)
+
+        for speaker in found:
+            if speaker.speaker_info.get('uid') in fresh:
+                logging.info('Found new speaker "%s"', speaker.speaker_info.get('zone_name'))
+                merged.append(speaker)
+                changed = True
+
+        if not changed:
+            return
+
+        self.add_speakers(merged)
+        if self.__current_speaker in merged:
+            index = merged.index(self.__current_speaker)
+            self._listbox.selection_set(index)
+            self._listbox.see(index)
+
+    def _poll_session_checks(self):
+        if not self._session_checks:
+            self.__parent.after(SESSION_POLL, self._poll_session_checks)
+            return
+
+        speaker, version, queue = self._session_checks.popleft()
+        # Dropped when another speaker was picked or the queue was loaded or
+        # edited in the meantime
+        if queue is None or speaker is not self.__current_speaker or \
+           version != self.__queue_content.version:
+            return
+
+        self._set_queue(speaker, queue)
+        if self._last_track:
+            self._select_queue_uri(self._last_track.get('uri'))
+
+    def _save_session_periodically(self):
+        try:
+            self._save_session()
+        except:
+            logging.error('Could not save session')
+            logging.error(traceback.format_exc())
+        self.__parent.after(SESSION_SAVE_INTERVAL, self._save_session_periodically)
+
+    def _save_session(self):
+        # A replay must not replace the session of the real speakers
+        if not self._connection or self._player is not None:
+            return
+
+        with perf.recorder.span('db.session'):
+            self._connection.execute('DELETE FROM speakers').close()
+            for speaker in self.__list_content:
+                info = speaker.speaker_info
+                self._connection.execute(
+                    'INSERT INTO speakers (name, ip, uid, serial, mac) VALUES (?, ?, ?, ?, ?)',
+                    (info.get('zone_name'),
+                     speaker.ip_address,
+                     info.get('uid'),
+                     info.get('serial_number'),
+                     info.get('mac_address'))).close()
+
+            speaker = self.__current_speaker
+            uid = speaker.speaker_info.get('uid') if speaker else None
+            if uid:
+                track = self._last_track or {}
+                art = track.get('album_art')
+                self._connection.execute(
+                    '''INSERT OR IGNORE INTO session_state (uid) VALUES (?)''',
+                    (uid, )).close()
+                self._connection.execute(
+                    '''UPDATE session_state
+                       SET track = ?, art_uri = ?, art_hash = ?, saved = ?
+                       WHERE uid = ?''',
+                    (json.dumps(track, default = str),
+                     art,
+                     self.get_album_art_hash(art) if art else None,
+                     time.time(),
+                     uid)).close()
+
+                # The queue only when it changed since the last save. A queue
+                # without update ID did not finish loading, the stored one
+                # is kept.
+                queue = self.__queue_content
+                if self.__queue_speaker is speaker and \
+                   queue.update_id is not None and \
+                   self._session_saved != (uid, queue.version):
+                    self._connection.execute(
+                        '''UPDATE session_state SET queue_update_id = ?, queue = ?
+                           WHERE uid = ?''',
+                        (queue.update_id, sql.Binary(queue.to_bytes()), uid)).close()
+                    self._session_saved = (uid, queue.version)
+
+            self._connection.commit()
 
     def __set_config(self, setting_name, value):
         assert setting_name is not None
 
         __sql = 'INSERT OR REPLACE INTO config (name, value) VALUES (?, ?)'
 
-        self._connection.execute(__sql, (setting_name, value)).close()
-        self._connection.commit()
+        with perf.recorder.span('db.set_config'):
+            self._connection.execute(__sql, (setting_name, value)).close()
+            self._connection.commit()
         
     def __get_config(self, setting_name):
         assert setting_name is not None
 
         __sql = 'SELECT value FROM config WHERE name = ? LIMIT 1'
 
-        with clib.closing(self._connection.execute(__sql, (setting_name, ))) as cur:
+        with perf.recorder.span('db.get_config'), \
+             clib.closing(self._connection.execute(__sql, (setting_name, ))) as cur:
             row = cur.fetchone()
 
             if not row:
@@ -895,36 +1798,437 @@ class SonosList(tk.PanedWindow):
                 PRIMARY KEY(speaker_id)
             );
                 
-            CREATE TABLE IF NOT EXISTS images(
-                uri             TEXT UNIQUE,
-                image           BLOB,
+            CREATE TABLE IF NOT EXISTS art_urls(
+                uri             TEXT,
+                hash            TEXT,
                 PRIMARY KEY(uri)
             );
+
+            CREATE TABLE IF NOT EXISTS art_blobs(
+                hash            TEXT,
+                image           BLOB,
+                PRIMARY KEY(hash)
+            );
+
+            CREATE TABLE IF NOT EXISTS session_state(
+                uid             TEXT,
+                queue_update_id INTEGER,
+                queue           BLOB,
+                track           TEXT,
+                art_uri         TEXT,
+                art_hash        TEXT,
+                saved           REAL,
+                PRIMARY KEY(uid)
+            );
+
+            CREATE TABLE IF NOT EXISTS art_thumbs(
+                hash            TEXT,
+                width           INTEGER,
+                height          INTEGER,
+                mode            TEXT,
+                thumb_width     INTEGER,
+                thumb_height    INTEGER,
+                pixels          BLOB,
+                PRIMARY KEY(hash, width, height)
+            );
         ''').close()
 
+        self._migrate_images()
+
         logging.debug('Creating index')
-        self._connection.execute('''
-            CREATE INDEX IF NOT EXISTS idx_image_uri ON images(uri)
-        ''').close()
 
         self._connection.execute('''
             CREATE INDEX IF NOT EXISTS idx_config_name ON config(name)
         ''').close()
 
-def main(root):
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS library_state(
+                source              TEXT,
+                category            TEXT,
+                update_id           INTEGER,
+                system_update_id    TEXT,
+                total               INTEGER,
+                refreshed           REAL,
+                PRIMARY KEY(source, category)
+            );
+
+            CREATE TABLE IF NOT EXISTS library_pages(
+                source      TEXT,
+                category    TEXT,
+                start       INTEGER,
+                PRIMARY KEY(source, category, start)
+            );
+
+            CREATE TABLE IF NOT EXISTS library_items(
+                item_rowid  INTEGER,
+                source      TEXT,
+                category    TEXT,
+                position    INTEGER,
+                item_id     TEXT,
+                title       TEXT,
+                creator     TEXT,
+                album       TEXT,
+                item_class  TEXT,
+                uri         TEXT,
+                didl        TEXT,
+                PRIMARY KEY(item_rowid),
+                UNIQUE(source, category, position)
+            );
+        ''').close()
+
+        try:
+            self._connection.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS library_fts
+                USING fts4(title, creator, album)
+            ''').close()
+        except sql.OperationalError:
+            logging.warning('SQLite has no FTS4, library search will be slow')
+
+
+    def _migrate_images(self):
+        # Art used to be stored once per URL in the images table
+        with clib.closing(self._connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'images'")) as cur:
+            if cur.fetchone() is None:
+                return
+
+        logging.info('Moving album art to content addressed storage')
+        with clib.closing(self._connection.execute(
+                'SELECT uri, image FROM images')) as cur:
+            for row in cur:
+                data = bytes(row['image'])
+                digest = artwork.digest(data)
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO art_urls (uri, hash) VALUES (?, ?)',
+                    (row['uri'], digest)).close()
+                self._connection.execute(
+                    'INSERT OR IGNORE INTO art_blobs (hash, image) VALUES (?, ?)',
+                    (digest, sql.Binary(data))).close()
+
+        self._connection.execute('DROP TABLE images').close()
+        self._connection.commit()
+
+
+class LibraryBrowser(tk.Toplevel):
+
+    def __init__(self, parent, sonos_list, speaker):
+        tk.Toplevel.__init__(self, parent)
+        self.wm_title('Library')
+
+        self._sonos_list = sonos_list
+        self._speaker = speaker
+        self._library = library.MusicLibrary(sonos_list._connection,
+                                             sonos_list._speaker_call)
+
+        self._rows = []
+        self._total = None
+        self._loading = False
+        self._searching = False
+        self._failed = False
+        self._ready = False
+        # Bumped when the list is reset, results for an older list are dropped
+        self._generation = 0
+        self._workers = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        self._pending = None
+        self._poll_id = None
+
+        self.create_widgets()
+
+        # Both speaker round trips run on the worker, the list comes up
+        # once they are back
+        self._loading = True
+        self._status.config(text = 'Checking library...')
+        self._submit(self._validated,
+                     self._library.fetch_validation,
+                     speaker)
+
+    def destroy(self):
+        if self._poll_id is not None:
+            self.after_cancel(self._poll_id)
+            self._poll_id = None
+        self._workers.shutdown(wait = False)
+        tk.Toplevel.destroy(self)
+
+    def _submit(self, done, func, *args):
+        # done(future) runs on the Tk thread once func(*args) finished
+        self._pending = (self._generation,
+                         self._workers.submit(func, *args),
+                         done)
+        if self._poll_id is None:
+            self._poll_id = self.after(LIBRARY_POLL, self._poll)
+
+    def _poll(self):
+        self._poll_id = None
+        generation, future, done = self._pending
+        if not future.done():
+            self._poll_id = self.after(LIBRARY_POLL, self._poll)
+            return
+
+        self._pending = None
+        self._loading = False
+        if generation == self._generation:
+            done(future)
+
+    def _validated(self, future):
+        try:
+            self._library.validate(*future.result())
+        except:
+            logging.error('Could not validate library cache')
+            logging.error(traceback.format_exc())
+
+        self._ready = True
+        self.show_category()
+
+    def create_widgets(self):
+        self._category = tk.StringVar(value = library.CATEGORIES[0])
+        category_menu = tk.OptionMenu(self,
+                                      self._category,
+                                      *library.CATEGORIES,
+                                      command = self.show_category)
+        category_menu.grid(row = 0,
+                           column = 0,
+                           padx = 5,
+                           pady = 5,
+                           sticky = 'w')
+
+        self._search = tk.StringVar()
+        search_entry = tk.Entry(self,
+                                textvariable = self._search)
+        # Searches the cache, fast enough to run on every change
+        self._search.trace('w', self._search_changed)
+        search_entry.grid(row = 0,
+                          column = 1,
+                          columnspan = 2,
+                          padx = 5,
+                          pady = 5,
+                          sticky = 'we')
+
+        self._scrollbar = tk.Scrollbar(self)
+        self._listbox = tk.Listbox(self,
+                                   selectmode = tk.EXTENDED,
+                                   width = 60,
+                                   height = 25)
+
+        self._scrollbar.config(command = self._listbox.yview)
+        self._listbox.config(yscrollcommand = self._scrolled)
+
+        self._listbox.grid(row = 1,
+                           column = 0,
+                           columnspan = 2,
+                           padx = 5,
+                           pady = 5,
+                           sticky = 'news')
+        self._scrollbar.grid(row = 1,
+                             column = 2,
+                             pady = 5,
+                             sticky = 'ns')
+
+        self._listbox.bind('<Double-Button-1>', self._add_selected)
+
+        self._status = tk.Label(self, text = '', anchor = 'w')
+        self._status.grid(row = 2,
+                          column = 0,
+                          columnspan = 2,
+                          padx = 5,
+                          sticky = 'we')
+
+        button_add = tk.Button(self,
+                               command = self._add_selected,
+                               text = 'Add to queue')
+        button_add.grid(row = 2,
+                        column = 2,
+                        padx = 5,
+                        pady = 5,
+                        sticky = 'e')
+
+        self.rowconfigure(1, weight = 1)
+        self.columnconfigure(1, weight = 1)
+
+    def selected_rowids(self):
+        return [self._rows[int(index)] for index in self._listbox.curselection()]
+
+    def _add_selected(self, evt = None):
+        try:
+            items = self._library.items(self.selected_rowids())
+        except:
+            logging.error('Could not read library items')
+            logging.error(traceback.format_exc())
+            return
+
+        self._sonos_list.add_to_queue(items)
+
+    def show_category(self, *args):
+        self._searching = False
+        self._search.set('')
+        if not self._ready:
+            # Shown once the library is validated
+            return
+
+        self._generation += 1
+        self._loading = False
+        self._failed = False
+        self._rows = []
+        self._total = None
+        self._listbox.delete(0, tk.END)
+        self.load_more()
+
+    def load_more(self):
+        # Next page, from the cache or fetched on the worker. Called when
+        # the list is scrolled near its end.
+        if self._loading or self._searching or self._failed:
+            return
+        if self._total is not None and len(self._rows) >= self._total:
+            return
+
+        category = self._category.get()
+        start = len(self._rows)
+        try:
+            cached = self._library.cached_page(category, start)
+        except:
+            logging.error('Could not read library cache')
+            logging.error(traceback.format_exc())
+            cached = None
+
+        if cached is not None:
+            rows, self._total = cached
+            self._add_rows(rows)
+            self._show_status()
+            return
+
+        self._loading = True
+        self._show_status()
+        self._submit(lambda future: self._fetched(category, start, future),
+                     self._library.fetch,
+                     self._speaker,
+                     category,
+                     start)
+
+    def _fetched(self, category, start, future):
+        try:
+            rows, self._total = self._library.store_page(category,
+                                                         start,
+                                                         future.result())
+            self._add_rows(rows)
+        except OSError:
+            logging.warning('Could not browse library: %s',
+                            traceback.format_exc().splitlines()[-1])
+            self._failed = True
+        except:
+            logging.error('Could not browse library')
+            logging.error(traceback.format_exc())
+            self._failed = True
+        self._show_status()
+
+    def _show_status(self):
+        category = self._category.get()
+        if self._failed:
+            text = 'Could not load {}, {} shown'.format(category, len(self._rows))
+        elif self._total is None:
+            text = 'Loading {}...'.format(category)
+        else:
+            text = '{} of {} {}'.format(len(self._rows), self._total, category)
+            if self._loading:
+                text += ', loading...'
+        self._status.config(text = text)
+
+    def _add_rows(self, rows):
+        labels = []
+        for row in rows:
+            self._rows.append(row['item_rowid'])
+            if row['creator']:
+                labels.append('{} - {}'.format(row['creator'], row['title']))
+            else:
+                labels.append(row['title'])
+        if labels:
+            self._listbox.insert(tk.END, *labels)
+
+    def _scrolled(self, first, last):
+        self._scrollbar.set(first, last)
+        if float(last) > 0.9:
+            self.after_idle(self.load_more)
+
+    def _search_changed(self, *args):
+        text = self._search.get()
+        if not self._ready:
+            return
+        if not text:
+            if self._searching:
+                self.show_category()
+            return
+
+        category = self._category.get()
+        self._searching = True
+        # A page still loading belongs to the list replaced here
+        self._generation += 1
+        self._loading = False
+        self._rows = []
+        self._listbox.delete(0, tk.END)
+        try:
+            self._add_rows(self._library.search(category, text))
+            cached = self._library.cached_count(category)
+        except:
+            logging.error('Could not search library')
+            logging.error(traceback.format_exc())
+            cached = 0
+
+        self._status.config(text = '{} found in {} cached {}'.format(
+            len(self._rows), cached, category))
+
+def main(root, options):
     logging.debug('Main')
-    sonosList = SonosList(root)
+    recorder = None
+    player = None
+    if options.record:
+        recorder = replay.Recorder(options.record)
+    elif options.replay:
+        player = replay.Player(options.replay, latency = options.replay_latency)
+
+    if options.perf_report:
+        perf.recorder.enabled = True
+
+    server = None
+    if options.metrics_port is not None:
+        server = metrics.serve(options.metrics_port)
+
+    sonosList = SonosList(root, recorder = recorder, player = player)
+    if options.exit_after:
+        root.after(int(options.exit_after * 1000), sonosList.clean_exit)
     sonosList.mainloop()
     sonosList.destroy()
 
+    if options.perf_report:
+        perf.recorder.dump(options.perf_report)
+    if server is not None:
+        server.shutdown()
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Tk client for Sonos speakers')
+    traffic = parser.add_mutually_exclusive_group()
+    traffic.add_argument('--record', metavar = 'FILE',
+                         help = 'record all speaker traffic to FILE')
+    traffic.add_argument('--replay', metavar = 'FILE',
+                         help = 'answer speaker traffic from a recording instead of the network')
+    parser.add_argument('--replay-latency', metavar = 'SCALE', type = float, default = 1.0,
+                        help = 'scale of the recorded latencies, 0 answers at once (default: 1)')
+    parser.add_argument('--exit-after', metavar = 'SECONDS', type = float,
+                        help = 'exit on its own after SECONDS')
+    parser.add_argument('--metrics-port', metavar = 'PORT', type = int,
+                        help = 'serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--perf-report', metavar = 'FILE',
+                        help = 'record timings and write the report to FILE on exit')
+    return parser.parse_args()
+
 if __name__ == '__main__':
+    options = parse_args()
     logging.info('Using data dir: "%s"', USER_DATA)
     
     root = tk.Tk()
     try:
         root.wm_title('SoCo')
         root.minsize(800,400)
-        main(root)
+        main(root, options)
 ##    except:
 ##        logging.debug(traceback.format_exc())
     finally:
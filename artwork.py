@@ -0,0 +1,82 @@
+"""
+Album art loading off the Tk thread.
+
+Fetching, decoding and thumbnailing run in a worker pool and hand back raw
+pixel buffers, the Tk thread only wraps them in a PhotoImage. Pillow drops
+the GIL while decoding and resampling, so threads are used by default, a
+process pool can be asked for when that is not enough.
+
+Art is identified by the hash of its content, Sonos art URLs contain the
+track so every track of an album has its own URL for the same image.
+"""
+
+import concurrent.futures
+import hashlib
+import logging
+
+import requests
+
+import perf
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def fetch(url, timeout = None):
+    response = requests.get(url, timeout = timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def thumbnail(data, size):
+    from io import BytesIO
+
+    image = Image.open(BytesIO(data))
+    # Lets the JPEG decoder scale down while decoding
+    image.draft('RGB', size)
+    image.thumbnail(size, getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    return image.mode, image.size, image.tobytes()
+
+
+class ArtLoader(object):
+
+    def __init__(self, processes = False, timeout = None, fetch = fetch):
+        self._timeout = timeout
+        self._fetch = fetch
+        self._workers = concurrent.futures.ThreadPoolExecutor(max_workers = 2)
+        self._decoder = None
+        if processes:
+            self._decoder = concurrent.futures.ProcessPoolExecutor(max_workers = 1)
+
+    def fetch(self, url):
+        # Future of (data, content hash)
+        return self._workers.submit(self._load, url)
+
+    def decode(self, data, size):
+        # Future of (mode, size, pixels)
+        return self._workers.submit(self._decode, data, size)
+
+    def _load(self, url):
+        logging.info('Could not find cached album art, loading from URL')
+        with perf.recorder.span('http.album_art'):
+            data = self._fetch(url, timeout = self._timeout)
+        return data, digest(data)
+
+    def _decode(self, data, size):
+        with perf.recorder.span('image.decode'):
+            if self._decoder is not None:
+                return self._decoder.submit(thumbnail, data, size).result()
+            return thumbnail(data, size)
+
+    def shutdown(self):
+        self._workers.shutdown(wait = False)
+        if self._decoder is not None:
+            self._decoder.shutdown(wait = False)
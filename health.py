@@ -0,0 +1,143 @@
+"""
+Per-speaker health tracking and circuit breaking.
+
+Every call to a speaker reports its latency and outcome. After a few
+connection failures in a row the circuit opens and calls fail fast with
+SpeakerUnavailable until the backoff expires, then a single probe call is
+let through (half-open) to decide whether to close the circuit again.
+"""
+
+import logging
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Consecutive connection failures that open the circuit
+FAILURE_THRESHOLD = 3
+
+# Backoff (seconds) before the first probe, doubled for each failed probe
+BACKOFF_START = 2.0
+BACKOFF_MAX = 60.0
+
+# Weight of the newest sample in the latency average
+LATENCY_ALPHA = 0.3
+
+# Average latency (seconds) from which a speaker counts as degraded
+LATENCY_SLOW = 1.0
+
+
+class SpeakerUnavailable(ConnectionError):
+    pass
+
+
+class SpeakerHealth(object):
+
+    __slots__ = ('state', 'latency', 'calls', 'failures', 'consecutive',
+                 'backoff', 'retry_at', 'probing')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.latency = None
+        self.calls = 0
+        self.failures = 0
+        self.consecutive = 0
+        self.backoff = BACKOFF_START
+        self.retry_at = 0.0
+        self.probing = False
+
+    def allow(self, now):
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and now >= self.retry_at:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def success(self, elapsed):
+        self.calls += 1
+        self.consecutive = 0
+        self.probing = False
+        self.state = CLOSED
+        self.backoff = BACKOFF_START
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += LATENCY_ALPHA * (elapsed - self.latency)
+
+    def failure(self, now):
+        self.calls += 1
+        self.failures += 1
+        self.consecutive += 1
+        self.probing = False
+
+        if self.state == HALF_OPEN or self.consecutive >= FAILURE_THRESHOLD:
+            self.state = OPEN
+            self.retry_at = now + self.backoff
+            self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+
+    def degraded(self):
+        if self.state != CLOSED or self.consecutive:
+            return True
+        return self.latency is not None and self.latency > LATENCY_SLOW
+
+    def describe(self):
+        # Only changes with the state, the speaker list redraws a row when
+        # its text changes. The backoff countdown goes to the log.
+        if self.state == OPEN:
+            return 'offline'
+        if self.state == HALF_OPEN:
+            return 'retrying'
+        if self.consecutive:
+            return '{} failed'.format(self.consecutive)
+        if self.degraded():
+            return 'slow'
+        return None
+
+
+class HealthRegistry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._speakers = {}
+
+    def get(self, key):
+        with self._lock:
+            health = self._speakers.get(key)
+            if health is None:
+                health = self._speakers[key] = SpeakerHealth()
+            return health
+
+    def call(self, key, func, *args, **kwargs):
+        health = self.get(key)
+        with self._lock:
+            if not health.allow(time.monotonic()):
+                raise SpeakerUnavailable('Speaker {} is unreachable, retry in {:.0f}s'.format(
+                    key, max(health.retry_at - time.monotonic(), 0)))
+
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except OSError:
+            # Covers socket errors and everything requests raises, an UPnP
+            # error reply still means the speaker is there.
+            with self._lock:
+                now = time.monotonic()
+                health.failure(now)
+                opened = health.state == OPEN
+                retry = health.retry_at - now
+            if opened:
+                logging.warning('Speaker %s is unreachable, retry in %.0fs', key, retry)
+            raise
+        except Exception:
+            with self._lock:
+                health.success(time.monotonic() - start)
+            raise
+
+        with self._lock:
+            health.success(time.monotonic() - start)
+        return result
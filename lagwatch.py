@@ -0,0 +1,109 @@
+"""
+Watches the Tk main loop from a separate thread.
+
+The main thread calls beat() from an after() callback. When a beat is late
+by more than the threshold the watcher grabs the main thread's stack, so
+whatever is blocking the loop shows up in the log, and keeps the worst
+stalls around for later inspection.
+"""
+
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+import traceback
+
+
+class Stall(object):
+
+    __slots__ = ('started', 'duration', 'stack')
+
+    def __init__(self, started, stack):
+        self.started = started
+        self.duration = None
+        self.stack = stack
+
+
+class Watchdog(threading.Thread):
+
+    def __init__(self, interval, threshold, keep = 10):
+        threading.Thread.__init__(self, name = 'main-loop-watchdog')
+        self.daemon = True
+
+        self.interval = interval
+        self.threshold = threshold
+        self.keep = keep
+
+        self._main_ident = threading.current_thread().ident
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._last_beat = time.monotonic()
+        self._stall = None
+        self._worst = []
+        self._order = itertools.count()
+
+    def beat(self):
+        now = time.monotonic()
+        with self._lock:
+            stall = self._stall
+            self._stall = None
+            self._last_beat = now
+
+        if stall is None:
+            return None
+
+        stall.duration = now - stall.started
+        logging.warning('Main loop was blocked for %d ms',
+                        stall.duration * 1000)
+        with self._lock:
+            entry = (stall.duration, next(self._order), stall)
+            if len(self._worst) < self.keep:
+                heapq.heappush(self._worst, entry)
+            else:
+                heapq.heappushpop(self._worst, entry)
+        return stall
+
+    def run(self):
+        poll = min(self.interval, self.threshold) / 2.0
+        while not self._stopped.wait(poll):
+            with self._lock:
+                if self._stall is not None:
+                    continue
+                due = self._last_beat + self.interval
+                if time.monotonic() - due < self.threshold:
+                    continue
+
+                frame = sys._current_frames().get(self._main_ident)
+                if frame is None:
+                    continue
+                stack = ''.join(traceback.format_stack(frame))
+                self._stall = Stall(due, stack)
+
+            logging.warning('Main loop blocked for more than %d ms in:\n%s',
+                            self.threshold * 1000, stack)
+
+    def stop(self):
+        self._stopped.set()
+
+    def stalls(self):
+        with self._lock:
+            entries = sorted(self._worst, reverse = True)
+        return [stall for _, _, stall in entries]
+
+    def report(self, stacks = True):
+        stalls = self.stalls()
+        if not stalls:
+            return 'No main loop stalls over {:.0f} ms'.format(self.threshold * 1000)
+
+        lines = ['Worst main loop stalls (threshold {:.0f} ms)'.format(
+            self.threshold * 1000)]
+        for stall in stalls:
+            lines.append('')
+            lines.append('{:.0f} ms, {:.0f}s ago'.format(
+                stall.duration * 1000,
+                time.monotonic() - stall.started))
+            if stacks:
+                lines.append(stall.stack.rstrip())
+        return '\n'.join(lines)
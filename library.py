@@ -0,0 +1,262 @@
+"""
+Cached, paged access to the Sonos music library.
+
+Pages are fetched from the speaker the first time they are looked at and
+stored in the library_* tables, searches run against a full-text index of
+the cached items. The speaker's system update ID tells whether the library
+changed at all, the update ID of a browse result whether a category
+changed, only changed categories are dropped from the cache.
+
+Talking to the speaker (fetch_validation, fetch) and to the database
+(validate, cached_page, store_page) are separate steps, the first can run
+on a worker thread while the connection stays on the Tk thread.
+"""
+
+import contextlib as clib
+import logging
+import time
+import traceback
+
+import perf
+from queue_model import tokenize
+
+CATEGORIES = ('artists', 'albums', 'tracks', 'playlists')
+
+# Items fetched per browse request
+PAGE_SIZE = 100
+
+# Rows returned by a search
+SEARCH_LIMIT = 500
+
+
+def _from_didl_string(string):
+    try:
+        from soco.data_structures_entry import from_didl_string
+    except ImportError:
+        from soco.data_structures import from_didl_string
+    return from_didl_string(string)
+
+
+def _to_didl_string(item):
+    from soco.data_structures import to_didl_string
+    return to_didl_string(item)
+
+
+class MusicLibrary(object):
+
+    def __init__(self, connection, call):
+        # call(speaker, method, *args) goes through the speaker health and
+        # instrumentation of the caller
+        self._connection = connection
+        self._call = call
+        self._source = None
+        self._system_id = None
+        self._checked = set()
+        self._has_fts = self._fts_available()
+
+    def _fts_available(self):
+        with clib.closing(self._connection.execute(
+                "SELECT name FROM sqlite_master WHERE name = 'library_fts'")) as cur:
+            return cur.fetchone() is not None
+
+    def fetch_validation(self, speaker):
+        # (source, system update ID) for validate()
+        try:
+            source = self._call(speaker, 'household_id')
+        except:
+            logging.warning('Could not get household, using speaker address')
+            source = speaker.ip_address
+
+        try:
+            system_id = self._call(speaker, 'contentDirectory.GetSystemUpdateID')['Id']
+        except:
+            logging.warning('Could not get library update ID')
+            logging.debug(traceback.format_exc())
+            system_id = None
+        return source, system_id
+
+    def validate(self, source, system_id):
+        # Categories stored under the current system update ID are known to
+        # be up to date, the others get checked on their next browse.
+        self._source = source
+        self._checked = set()
+        self._system_id = system_id
+        if system_id is None:
+            return
+
+        with perf.recorder.span('db.library'), \
+             clib.closing(self._connection.execute(
+                'SELECT category, system_update_id FROM library_state WHERE source = ?',
+                (self._source, ))) as cur:
+            for row in cur.fetchall():
+                if row['system_update_id'] == self._system_id:
+                    self._checked.add(row['category'])
+
+    def state(self, category):
+        with perf.recorder.span('db.library'), \
+             clib.closing(self._connection.execute(
+                'SELECT * FROM library_state WHERE source = ? AND category = ?',
+                (self._source, category))) as cur:
+            return cur.fetchone()
+
+    def cached_page(self, category, start):
+        # Rows of the page at start and the size of the category, None when
+        # the page has to be fetched
+        if category in self._checked and self._page_cached(category, start):
+            perf.recorder.count('library.page.cached')
+            return self._rows(category, start, PAGE_SIZE), self.state(category)['total']
+        return None
+
+    def fetch(self, speaker, category, start):
+        # Browse result for store_page()
+        perf.recorder.count('library.page.fetched')
+        return self._call(speaker,
+                          'music_library.get_music_library_information',
+                          category,
+                          start,
+                          PAGE_SIZE)
+
+    def store_page(self, category, start, result):
+        # Rows of the fetched page and the size of the category
+        update_id = getattr(result, 'update_id', None)
+        total = getattr(result, 'total_matches', len(result))
+        state = self.state(category)
+        if state is None or state['update_id'] != update_id:
+            logging.info('Library category "%s" changed, dropping cache', category)
+            self._drop(category)
+        elif self._page_cached(category, start):
+            # Unchanged, the rest of the cached pages can be used as well
+            with perf.recorder.span('db.library'):
+                self._store_state(category, update_id, total)
+                self._connection.commit()
+            self._checked.add(category)
+            return self._rows(category, start, PAGE_SIZE), total
+
+        self._store(category, start, result, update_id, total)
+        self._checked.add(category)
+        return self._rows(category, start, PAGE_SIZE), total
+
+    def _page_cached(self, category, start):
+        with perf.recorder.span('db.library'), \
+             clib.closing(self._connection.execute(
+                'SELECT 1 FROM library_pages WHERE source = ? AND category = ? AND start = ?',
+                (self._source, category, start))) as cur:
+            return cur.fetchone() is not None
+
+    def _rows(self, category, start, count):
+        with perf.recorder.span('db.library'), \
+             clib.closing(self._connection.execute(
+                 '''SELECT item_rowid, title, creator, album, item_class
+                    FROM library_items
+                    WHERE source = ? AND category = ? AND position >= ?
+                    ORDER BY position LIMIT ?''',
+                 (self._source, category, start, count))) as cur:
+            return cur.fetchall()
+
+    def _drop(self, category):
+        with perf.recorder.span('db.library'):
+            if self._has_fts:
+                self._connection.execute(
+                    '''DELETE FROM library_fts WHERE rowid IN (
+                           SELECT item_rowid FROM library_items
+                           WHERE source = ? AND category = ?)''',
+                    (self._source, category)).close()
+            for table in ('library_items', 'library_pages', 'library_state'):
+                self._connection.execute(
+                    'DELETE FROM {} WHERE source = ? AND category = ?'.format(table),
+                    (self._source, category)).close()
+            self._connection.commit()
+
+    def _store(self, category, start, items, update_id, total):
+        with perf.recorder.span('db.library'):
+            for position, item in enumerate(items, start):
+                resources = getattr(item, 'resources', None)
+                cur = self._connection.execute(
+                    '''INSERT OR REPLACE INTO library_items
+                       (source, category, position, item_id, title, creator,
+                        album, item_class, uri, didl)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                    (self._source,
+                     category,
+                     position,
+                     item.item_id,
+                     item.title,
+                     getattr(item, 'creator', None),
+                     getattr(item, 'album', None),
+                     item.item_class,
+                     resources[0].uri if resources else None,
+                     _to_didl_string(item)))
+                rowid = cur.lastrowid
+                cur.close()
+
+                if self._has_fts:
+                    self._connection.execute(
+                        '''INSERT OR REPLACE INTO library_fts (rowid, title, creator, album)
+                           VALUES (?, ?, ?, ?)''',
+                        (rowid,
+                         item.title,
+                         getattr(item, 'creator', None),
+                         getattr(item, 'album', None))).close()
+
+            self._connection.execute(
+                'INSERT OR REPLACE INTO library_pages (source, category, start) VALUES (?, ?, ?)',
+                (self._source, category, start)).close()
+            self._store_state(category, update_id, total)
+            self._connection.commit()
+
+    def _store_state(self, category, update_id, total):
+        self._connection.execute(
+            '''INSERT OR REPLACE INTO library_state
+               (source, category, update_id, system_update_id, total, refreshed)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            (self._source, category, update_id, self._system_id, total,
+             time.time())).close()
+
+    def cached_count(self, category):
+        with perf.recorder.span('db.library'), \
+             clib.closing(self._connection.execute(
+                'SELECT COUNT(*) FROM library_items WHERE source = ? AND category = ?',
+                (self._source, category))) as cur:
+            return cur.fetchone()[0]
+
+    def search(self, category, text):
+        words = tokenize(text)
+        if not words:
+            return []
+
+        with perf.recorder.span('db.library_search'):
+            if self._has_fts:
+                query = ' '.join(word + '*' for word in words)
+                cur = self._connection.execute(
+                    '''SELECT i.item_rowid, i.title, i.creator, i.album, i.item_class
+                       FROM library_fts f JOIN library_items i ON i.item_rowid = f.rowid
+                       WHERE library_fts MATCH ? AND i.source = ? AND i.category = ?
+                       ORDER BY i.position LIMIT ?''',
+                    (query, self._source, category, SEARCH_LIMIT))
+            else:
+                where = ' AND '.join(
+                    "(title || ' ' || IFNULL(creator, '') || ' ' || IFNULL(album, '')) LIKE ?"
+                    for word in words)
+                cur = self._connection.execute(
+                    '''SELECT item_rowid, title, creator, album, item_class
+                       FROM library_items
+                       WHERE source = ? AND category = ? AND {}
+                       ORDER BY position LIMIT ?'''.format(where),
+                    [self._source, category] +
+                    ['%' + word + '%' for word in words] +
+                    [SEARCH_LIMIT])
+            with clib.closing(cur):
+                return cur.fetchall()
+
+    def items(self, rowids):
+        # Rebuild the DIDL objects, for adding them to a queue
+        result = []
+        for rowid in rowids:
+            with perf.recorder.span('db.library'), \
+                 clib.closing(self._connection.execute(
+                    'SELECT didl FROM library_items WHERE item_rowid = ?',
+                    (rowid, ))) as cur:
+                row = cur.fetchone()
+            if row is not None:
+                result.extend(_from_didl_string(row['didl']))
+        return result
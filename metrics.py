@@ -0,0 +1,254 @@
+"""
+Runtime metrics in the Prometheus text exposition format.
+
+Speaker calls are counted and timed per method and speaker. Everything
+else (database queries, album art cache, UI loop lag) comes in through the
+spans and counters of perf.recorder, which hands them to the registry while
+it listens. serve() makes them available on a local /metrics endpoint.
+
+Off by default, speaker_call() then hands back a shared no-op context
+manager like perf.recorder.span() does.
+"""
+
+import bisect
+import http.server
+import logging
+import socketserver
+import threading
+import time
+
+import perf
+
+# Upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# perf histograms and counters exported, as (metric, labels)
+PERF_HISTOGRAMS = {
+    'ui.loop_lag': ('sonos_tk_ui_loop_lag_seconds', ()),
+    'ui.stall': ('sonos_tk_ui_stall_seconds', ()),
+    'http.album_art': ('sonos_tk_art_fetch_seconds', ()),
+    'image.decode': ('sonos_tk_art_decode_seconds', ()),
+    'queue.search': ('sonos_tk_queue_search_seconds', ()),
+}
+
+PERF_COUNTERS = {
+    'art.cache.hit': ('sonos_tk_art_cache_lookups_total', (('result', 'hit'), )),
+    'art.cache.miss': ('sonos_tk_art_cache_lookups_total', (('result', 'miss'), )),
+    'art.dedup': ('sonos_tk_art_dedup_total', ()),
+    'ui.loop_lag.late': ('sonos_tk_ui_loop_lag_late_total', ()),
+    'ui.stalls': ('sonos_tk_ui_stalls_total', ()),
+    'library.page.cached': ('sonos_tk_library_pages_total', (('source', 'cache'), )),
+    'library.page.fetched': ('sonos_tk_library_pages_total', (('source', 'speaker'), )),
+}
+
+HELP = {
+    'sonos_tk_soco_call_seconds': 'Duration of calls to speakers.',
+    'sonos_tk_soco_call_errors_total': 'Calls to speakers that raised, by exception type.',
+    'sonos_tk_db_query_seconds': 'Duration of local database operations (settings, art, library, session).',
+    'sonos_tk_db_query_errors_total': 'Local database operations that raised.',
+    'sonos_tk_ui_loop_lag_seconds': 'Delay of the UI heartbeat over its interval.',
+    'sonos_tk_ui_stall_seconds': 'Duration of UI loop stalls seen by the watchdog.',
+    'sonos_tk_art_fetch_seconds': 'Duration of album art downloads.',
+    'sonos_tk_art_decode_seconds': 'Duration of album art decoding and scaling.',
+    'sonos_tk_queue_search_seconds': 'Duration of queue searches.',
+    'sonos_tk_art_cache_lookups_total': 'Album art cache lookups by result.',
+    'sonos_tk_art_dedup_total': 'Downloaded album art already cached under another URL.',
+    'sonos_tk_ui_loop_lag_late_total': 'UI heartbeats later than the lag threshold.',
+    'sonos_tk_ui_stalls_total': 'UI loop stalls seen by the watchdog.',
+    'sonos_tk_library_pages_total': 'Music library pages served by source.',
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra = ()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                          for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Histogram(object):
+
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+
+class _NullTimer(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _CallTimer(object):
+
+    __slots__ = ('_registry', '_labels', '_start')
+
+    def __init__(self, registry, labels):
+        self._registry = registry
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._registry.observe('sonos_tk_soco_call_seconds', self._labels,
+                               time.perf_counter() - self._start)
+        if exc_type is not None:
+            self._registry.inc('sonos_tk_soco_call_errors_total',
+                               self._labels + (('error', exc_type.__name__), ))
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        # name -> labels -> value or Histogram
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, labels, seconds):
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram()
+            histogram.add(seconds)
+
+    def inc(self, name, labels, value = 1):
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def speaker_call(self, method, speaker, zone):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _CallTimer(self, (('method', method),
+                                 ('speaker', speaker),
+                                 ('zone', zone or '')))
+
+    # perf.recorder listener, speaker calls are timed with their labels
+    # by speaker_call() instead
+
+    def record(self, name, seconds):
+        if name.startswith('db.'):
+            self.observe('sonos_tk_db_query_seconds', (('query', name[3:]), ), seconds)
+        elif name in PERF_HISTOGRAMS:
+            metric, labels = PERF_HISTOGRAMS[name]
+            self.observe(metric, labels, seconds)
+
+    def count(self, name, value = 1):
+        if name.startswith('db.') and name.endswith('.errors'):
+            self.inc('sonos_tk_db_query_errors_total', (('query', name[3:-7]), ), value)
+        elif name in PERF_COUNTERS:
+            metric, labels = PERF_COUNTERS[name]
+            self.inc(metric, labels, value)
+
+    def exposition(self):
+        with self._lock:
+            histograms = dict((name, dict((labels, (list(h.counts), h.count, h.total))
+                                          for labels, h in series.items()))
+                              for name, series in self._histograms.items())
+            counters = dict((name, dict(series))
+                            for name, series in self._counters.items())
+
+        lines = []
+        for name in sorted(histograms):
+            lines.append('# HELP {} {}'.format(name, HELP.get(name, name)))
+            lines.append('# TYPE {} histogram'.format(name))
+            for labels, (counts, count, total) in sorted(histograms[name].items()):
+                seen = 0
+                for bound, bucket in zip(BUCKETS, counts):
+                    seen += bucket
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(labels, (('le', _number(bound)), )), seen))
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels, (('le', '+Inf'), )), count))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), repr(total)))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+
+        for name in sorted(counters):
+            lines.append('# HELP {} {}'.format(name, HELP.get(name, name)))
+            lines.append('# TYPE {} counter'.format(name))
+            for labels, value in sorted(counters[name].items()):
+                lines.append('{}{} {}'.format(name, _labels(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer is Python 3.7 and up
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.debug('metrics: ' + fmt, *args)
+
+
+def serve(port, host = '127.0.0.1'):
+    # Starts collecting and serves /metrics from a daemon thread, None when
+    # the port can't be had
+    try:
+        server = _Server((host, port), _Handler)
+    except OSError as exc:
+        logging.error('Could not serve metrics on %s:%d: %s', host, port, exc)
+        return None
+    registry.enabled = True
+    perf.recorder.listeners.append(registry)
+
+    thread = threading.Thread(target = server.serve_forever,
+                              name = 'metrics',
+                              daemon = True)
+    thread.start()
+    logging.info('Serving metrics on http://%s:%d/metrics', host, server.server_port)
+    return server
+
+
+registry = Registry()
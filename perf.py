@@ -0,0 +1,165 @@
+"""
+Timing spans, histograms and counters for the hot paths of SoCo-Tk.
+
+Recording is off by default, in which case span() hands back a shared
+no-op context manager so instrumented code pays for one attribute lookup.
+Listeners (the metrics registry) get every sample, recording or not.
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+# Upper bounds (in milliseconds) of the histogram buckets, the last bucket
+# catches everything above.
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram(object):
+
+    __slots__ = ('counts', 'count', 'total', 'minimum', 'maximum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, millis):
+        self.counts[bisect.bisect_left(BUCKETS_MS, millis)] += 1
+        self.count += 1
+        self.total += millis
+        if self.minimum is None or millis < self.minimum:
+            self.minimum = millis
+        if self.maximum is None or millis > self.maximum:
+            self.maximum = millis
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                if index < len(BUCKETS_MS):
+                    return min(float(BUCKETS_MS[index]), self.maximum)
+                return self.maximum
+        return self.maximum
+
+
+class _NullSpan(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Span(object):
+
+    __slots__ = ('_recorder', '_name', '_start')
+
+    def __init__(self, recorder, name):
+        self._recorder = recorder
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._recorder.record(self._name, time.perf_counter() - self._start)
+        if exc_type is not None:
+            self._recorder.count(self._name + '.errors')
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.enabled = False
+        # Objects with record(name, seconds) and count(name, value)
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._started = time.time()
+
+    def span(self, name):
+        if not self.enabled and not self.listeners:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name, seconds):
+        for listener in self.listeners:
+            listener.record(name, seconds)
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(seconds * 1000.0)
+
+    def count(self, name, value = 1):
+        for listener in self.listeners:
+            listener.count(name, value)
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+            self._started = time.time()
+
+    def report(self):
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            started = self._started
+
+        lines = ['Recording for {:.0f}s'.format(time.time() - started), '']
+        lines.append('{:<32} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+            'operation', 'count', 'mean ms', 'p50 ms', 'p95 ms', 'max ms'))
+        for name, histogram in histograms:
+            lines.append('{:<32} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                name,
+                histogram.count,
+                histogram.mean(),
+                histogram.percentile(0.5),
+                histogram.percentile(0.95),
+                histogram.maximum))
+
+        if counters:
+            lines.append('')
+            lines.append('{:<32} {:>7}'.format('counter', 'value'))
+            for name, value in counters:
+                lines.append('{:<32} {:>7}'.format(name, value))
+
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        logging.info('Writing performance report to: %s', path)
+        with open(path, 'w') as handle:
+            handle.write(time.strftime('%Y-%m-%d %H:%M:%S\n\n'))
+            handle.write(self.report())
+            handle.write('\n')
+
+
+recorder = Recorder()
@@ -0,0 +1,319 @@
+"""
+Compact storage for speaker queues.
+
+SoCo hands back a full DIDL object per queue entry, the UI only ever reads a
+handful of strings from them. CompactQueue keeps those strings in one list
+per field, so a queue of tens of thousands of tracks is a few lists for the
+garbage collector instead of tens of thousands of object graphs. Repeated
+values (artist, album, DIDL class...) are shared between entries.
+
+Every entry also gets a key that survives edits to the queue, QueueIndex
+maps search tokens to those keys.
+"""
+
+import bisect
+import itertools
+from array import array
+import json
+import re
+import zlib
+
+# Fields kept per entry, what the views and the search need plus the ids
+# and resource of the item
+FIELDS = ('item_id', 'parent_id', 'item_class', 'title', 'creator', 'album',
+          'uri', 'protocol_info', 'album_art_uri')
+
+# Fields with few distinct values, stored once and shared between entries
+SHARED_FIELDS = ('parent_id', 'item_class', 'creator', 'album',
+                 'protocol_info')
+
+# Fields the search index covers
+SEARCH_FIELDS = ('title', 'creator', 'album')
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# Versions are unique across queues, a queue replacing another never has
+# the version of the one it replaced
+_versions = itertools.count(1)
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return _TOKEN.findall(text.lower())
+
+
+def runs(positions):
+    # Contiguous runs of positions as (start, count), in queue order
+    result = []
+    for position in sorted(set(positions)):
+        if result and result[-1][0] + result[-1][1] == position:
+            result[-1] = (result[-1][0], result[-1][1] + 1)
+        else:
+            result.append((position, 1))
+    return result
+
+
+def move_order(length, positions, insert_before):
+    # New order (as old positions) after moving positions in front of the
+    # entry at insert_before, length moves them to the end.
+    selected = sorted(set(positions))
+    chosen = set(selected)
+    others = [index for index in range(length) if index not in chosen]
+    split = bisect.bisect_left(others, insert_before)
+    return others[:split] + selected + others[split:]
+
+
+def reorder_ops(order):
+    # Block moves turning range(len(order)) into order, as (start, count,
+    # insert_before) on the queue as it is when the move is made. Every
+    # move matches one ReorderTracksInQueue request.
+    current = list(range(len(order)))
+    ops = []
+    for index, wanted in enumerate(order):
+        if current[index] == wanted:
+            continue
+
+        start = current.index(wanted, index)
+        count = 1
+        while start + count < len(current) and \
+              index + count < len(order) and \
+              current[start + count] == order[index + count]:
+            count += 1
+
+        ops.append((start, count, index))
+        current[index:start + count] = current[start:start + count] + current[index:start]
+    return ops
+
+
+class QueueRecord(object):
+
+    __slots__ = FIELDS
+
+    def __init__(self, *values):
+        for name, value in zip(FIELDS, values):
+            setattr(self, name, value)
+
+
+class QueueIndex(object):
+
+    # Keys are handed out in increasing order, so appending keeps every
+    # posting sorted. Postings are arrays, or the key itself for the many
+    # tokens only one entry has, a set per token would cost more than the
+    # queue columns themselves.
+
+    def __init__(self):
+        self._postings = {}
+        # Sorted tokens for prefix lookups, rebuilt by the first search
+        # after new tokens came in
+        self._tokens = None
+
+    def clear(self):
+        self._postings = {}
+        self._tokens = None
+
+    def _tokenize(self, texts):
+        return set(tokenize(' '.join(text for text in texts if text)))
+
+    def add(self, key, texts):
+        postings = self._postings
+        for token in self._tokenize(texts):
+            keys = postings.get(token)
+            if keys is None:
+                postings[token] = key
+                self._tokens = None
+            elif isinstance(keys, int):
+                postings[token] = array('l', (keys, key))
+            else:
+                keys.append(key)
+
+    def remove(self, entries):
+        # entries are (key, texts) with the texts the key was added with,
+        # each posting is filtered once however many of its keys go.
+        removed = {}
+        for key, texts in entries:
+            for token in self._tokenize(texts):
+                removed.setdefault(token, set()).add(key)
+
+        for token, keys in removed.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                continue
+            if isinstance(postings, int):
+                kept = () if postings in keys else (postings, )
+            else:
+                kept = array('l', (key for key in postings if key not in keys))
+
+            if len(kept) > 1:
+                self._postings[token] = kept
+            elif kept:
+                self._postings[token] = kept[0]
+            else:
+                del self._postings[token]
+                self._tokens = None
+
+    def search(self, query):
+        # Every word of the query has to prefix a word of the entry
+        words = sorted(set(tokenize(query)), key = len, reverse = True)
+        if not words:
+            return None
+
+        if self._tokens is None:
+            self._tokens = sorted(self._postings)
+        tokens = self._tokens
+
+        result = None
+        for word in words:
+            matched = set()
+            index = bisect.bisect_left(tokens, word)
+            while index < len(tokens) and tokens[index].startswith(word):
+                keys = self._postings[tokens[index]]
+                if isinstance(keys, int):
+                    matched.add(keys)
+                else:
+                    matched.update(keys)
+                index += 1
+
+            result = matched if result is None else result & matched
+            if not result:
+                break
+        return result
+
+
+class CompactQueue(object):
+
+    def __init__(self):
+        self.update_id = None
+        # Bumped on every change, tells whether a snapshot is out of date
+        self.version = next(_versions)
+        self._columns = dict((name, []) for name in FIELDS)
+        self._keys = []
+        self._next_key = 0
+        self._positions = None
+        self._shared = {}
+        self._uri_positions = None
+        self._index = QueueIndex()
+
+    def __len__(self):
+        return len(self._columns['title'])
+
+    def __getitem__(self, index):
+        return QueueRecord(*[self._columns[name][index] for name in FIELDS])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def clear(self):
+        for column in self._columns.values():
+            del column[:]
+        del self._keys[:]
+        self._positions = None
+        self._shared = {}
+        self._uri_positions = None
+        self._index.clear()
+        self.update_id = None
+        self.version = next(_versions)
+
+    def append(self, item):
+        self.extend((item, ))
+
+    def extend(self, items):
+        shared = self._shared
+        columns = [(name, self._columns[name], name in SHARED_FIELDS)
+                   for name in FIELDS]
+
+        for item in items:
+            values = self._values(item)
+            for name, column, is_shared in columns:
+                value = values[name]
+                if is_shared and value is not None:
+                    value = shared.setdefault(value, value)
+                column.append(value)
+
+            key = self._next_key
+            self._next_key += 1
+            if self._positions is not None:
+                self._positions[key] = len(self._keys)
+            self._keys.append(key)
+            self._index.add(key, [values[name] for name in SEARCH_FIELDS])
+
+        self._uri_positions = None
+        self.version = next(_versions)
+
+    def _values(self, item):
+        if isinstance(item, QueueRecord):
+            return dict((name, getattr(item, name)) for name in FIELDS)
+
+        values = dict((name, getattr(item, name, None)) for name in FIELDS)
+        resources = getattr(item, 'resources', None)
+        if resources:
+            values['uri'] = resources[0].uri
+            values['protocol_info'] = resources[0].protocol_info
+        return values
+
+    def remove(self, positions):
+        removed = set(positions)
+        self._index.remove((self._keys[position],
+                            [self._columns[name][position] for name in SEARCH_FIELDS])
+                           for position in removed)
+
+        keep = [index for index in range(len(self)) if index not in removed]
+        self._rearrange(keep)
+
+    def reorder(self, order):
+        self._rearrange(order)
+
+    def _rearrange(self, order):
+        for column in self._columns.values():
+            column[:] = [column[index] for index in order]
+        self._keys[:] = [self._keys[index] for index in order]
+        self._positions = None
+        self._uri_positions = None
+        self.version = next(_versions)
+
+    def to_bytes(self):
+        columns = [self._columns[name] for name in FIELDS]
+        return zlib.compress(json.dumps({
+            'update_id': self.update_id,
+            'fields': FIELDS,
+            'columns': columns}).encode('utf-8'))
+
+    def load_bytes(self, data):
+        # Replaces the content with a snapshot made by to_bytes
+        snapshot = json.loads(zlib.decompress(data).decode('utf-8'))
+        stored = dict(zip(snapshot['fields'], snapshot['columns']))
+        length = len(snapshot['columns'][0]) if snapshot['columns'] else 0
+        columns = [stored.get(name) or [None] * length for name in FIELDS]
+
+        self.clear()
+        self.extend(QueueRecord(*values) for values in zip(*columns))
+        self.update_id = snapshot['update_id']
+
+    def key(self, index):
+        return self._keys[index]
+
+    def position(self, key):
+        if self._positions is None:
+            self._positions = dict((key, index)
+                                   for index, key in enumerate(self._keys))
+        return self._positions.get(key)
+
+    def search(self, query):
+        # Positions in queue order, None when the query has no words
+        keys = self._index.search(query)
+        if keys is None:
+            return None
+        return sorted(self.position(key) for key in keys)
+
+    def label(self, index, fmt):
+        return fmt.format(self._columns['creator'][index],
+                          self._columns['title'][index])
+
+    def find_uri(self, uri):
+        if self._uri_positions is None:
+            positions = {}
+            for index, value in enumerate(self._columns['uri']):
+                positions.setdefault(value, index)
+            self._uri_positions = positions
+        return self._uri_positions.get(uri)
@@ -0,0 +1,240 @@
+"""
+Recording and replaying of speaker traffic.
+
+A Recorder wraps the calls SoCo-Tk makes to speakers, discovery and album
+art fetches, and writes every call with its timing and pickled response to
+a JSON lines file. A Player answers the same calls from such a file, with
+the original latency, a scaled one or none at all, so whole sessions can be
+profiled and compared without speakers on the network.
+
+Recordings contain pickles, only replay files you recorded yourself.
+"""
+
+import base64
+import collections
+import json
+import logging
+import pickle
+import threading
+import time
+
+
+def _describe(value):
+    # Stable text for call arguments, DIDL objects are known by their id
+    if isinstance(value, (list, tuple)):
+        return '[{}]'.format(', '.join(_describe(item) for item in value))
+    if hasattr(value, 'item_id'):
+        return '<{} {}>'.format(type(value).__name__, value.item_id)
+    return repr(value)
+
+
+def call_key(method, args, kwargs):
+    return '{}({})'.format(method, ', '.join(
+        [_describe(arg) for arg in args] +
+        ['{}={}'.format(name, _describe(kwargs[name])) for name in sorted(kwargs)]))
+
+
+def _pack(value):
+    try:
+        return base64.b64encode(pickle.dumps(value)).decode('ascii')
+    except Exception:
+        logging.warning('Could not record %r', type(value))
+        return None
+
+
+def _unpack(value):
+    if value is None:
+        return None
+    return pickle.loads(base64.b64decode(value))
+
+
+def _pack_error(exc):
+    # Exceptions with their own constructor arguments (SoCo's UPnP errors)
+    # don't unpickle, those are replayed by type name and message.
+    try:
+        data = pickle.dumps(exc)
+        pickle.loads(data)
+        return base64.b64encode(data).decode('ascii')
+    except Exception:
+        return {'type': type(exc).__name__,
+                'message': str(exc),
+                'os_error': isinstance(exc, OSError)}
+
+
+def _unpack_error(value):
+    if isinstance(value, dict):
+        cls = RecordedOSError if value['os_error'] else RecordedError
+        return cls('{}: {}'.format(value['type'], value['message']))
+    return _unpack(value)
+
+
+class ReplayMissing(LookupError):
+    pass
+
+
+class RecordedError(Exception):
+    pass
+
+
+class RecordedOSError(RecordedError, OSError):
+    pass
+
+
+class ReplaySpeaker(object):
+
+    def __init__(self, ip_address):
+        self.ip_address = ip_address
+        self.speaker_info = {}
+
+    def __str__(self):
+        return "{} (\"{}\")".format(self.speaker_info.get('zone_name'),
+                                    self.ip_address).title()
+
+
+class Recorder(object):
+
+    def __init__(self, path):
+        logging.info('Recording speaker traffic to: %s', path)
+        self._handle = open(path, 'w')
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+
+    def _write(self, entry):
+        with self._lock:
+            if self._handle is None:
+                return
+            self._handle.write(json.dumps(entry))
+            self._handle.write('\n')
+
+    def _record(self, kind, target, key, func, *args, **kwargs):
+        start = time.monotonic()
+        entry = {'kind': kind,
+                 'target': target,
+                 'key': key,
+                 'at': start - self._started}
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            entry['elapsed'] = time.monotonic() - start
+            entry['error'] = _pack_error(exc)
+            self._write(entry)
+            raise
+
+        entry['elapsed'] = time.monotonic() - start
+        entry['result'] = _pack(result)
+        self._write(entry)
+        return result
+
+    def note(self, name, value):
+        # State of the app a replay needs, like the speaker selected. Only
+        # the first note of a name is used.
+        self._write({'kind': 'note',
+                     'target': None,
+                     'key': name,
+                     'at': time.monotonic() - self._started,
+                     'elapsed': 0.0,
+                     'result': _pack(value)})
+
+    def wrap_call(self, invoke):
+        def call(speaker, method, *args, **kwargs):
+            return self._record('call',
+                                speaker.ip_address,
+                                call_key(method, args, kwargs),
+                                invoke, speaker, method, *args, **kwargs)
+        return call
+
+    def wrap_fetch(self, fetch):
+        def fetch_art(url, timeout = None):
+            return self._record('fetch', url, url, fetch, url, timeout = timeout)
+        return fetch_art
+
+    def wrap_discover(self, discover):
+        def discover_speakers():
+            # Speakers don't pickle, their addresses are enough to replay
+            start = time.monotonic()
+            speakers = discover()
+            self._write({'kind': 'discover',
+                         'target': None,
+                         'key': 'discover',
+                         'at': start - self._started,
+                         'elapsed': time.monotonic() - start,
+                         'result': _pack(sorted(speaker.ip_address
+                                                for speaker in speakers or ()))})
+            return speakers
+        return discover_speakers
+
+    def close(self):
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+
+
+class Player(object):
+
+    def __init__(self, path, latency = 1.0):
+        # latency scales the recorded durations, 0 answers at once
+        logging.info('Replaying speaker traffic from: %s', path)
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._entries = collections.defaultdict(collections.deque)
+        self._addresses = []
+
+        with open(path) as handle:
+            for line in handle:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self._entries[(entry['kind'], entry['target'], entry['key'])].append(entry)
+                if entry['kind'] == 'call' and entry['target'] not in self._addresses:
+                    self._addresses.append(entry['target'])
+
+        self._speakers = {}
+
+    def _next(self, kind, target, key):
+        with self._lock:
+            entries = self._entries.get((kind, target, key))
+            if not entries:
+                raise ReplayMissing('Nothing recorded for {} {} {}'.format(kind, target, key))
+            # The last answer is repeated once the recorded ones run out
+            entry = entries.popleft() if len(entries) > 1 else entries[0]
+
+        if self.latency:
+            time.sleep(entry['elapsed'] * self.latency)
+
+        if entry.get('error') is not None:
+            raise _unpack_error(entry['error'])
+        return _unpack(entry.get('result'))
+
+    def speaker(self, ip_address):
+        with self._lock:
+            speaker = self._speakers.get(ip_address)
+            if speaker is None:
+                speaker = self._speakers[ip_address] = ReplaySpeaker(ip_address)
+            return speaker
+
+    def call(self, speaker, method, *args, **kwargs):
+        result = self._next('call', speaker.ip_address, call_key(method, args, kwargs))
+        if method == 'get_speaker_info':
+            # SoCo keeps the info on the speaker as well
+            speaker.speaker_info = result
+        return result
+
+    def fetch(self, url, timeout = None):
+        return self._next('fetch', url, url)
+
+    def note(self, name):
+        with self._lock:
+            entries = self._entries.get(('note', None, name))
+        if not entries:
+            return None
+        return _unpack(entries[0].get('result'))
+
+    def discover(self):
+        try:
+            addresses = self._next('discover', None, 'discover')
+        except ReplayMissing:
+            addresses = self._addresses
+        # A list, so the speakers (and the calls made to them) come in the
+        # same order on every run
+        return [self.speaker(address) for address in addresses]
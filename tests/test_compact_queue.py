@@ -0,0 +1,97 @@
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from queue_model import CompactQueue, QueueRecord, move_order
+
+
+def track(number, creator = 'Artist', album = 'Album'):
+    return SimpleNamespace(item_id = 'Q:0/{}'.format(number),
+                           parent_id = 'Q:0',
+                           item_class = 'object.item.audioItem.musicTrack',
+                           title = 'Song {}'.format(number),
+                           creator = creator,
+                           album = album,
+                           album_art_uri = None,
+                           resources = [SimpleNamespace(uri = 'x-file:{}'.format(number),
+                                                        protocol_info = 'x-file:*:*:*')])
+
+
+class CompactQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = CompactQueue()
+        self.queue.extend(track(number) for number in range(5))
+
+    def titles(self):
+        return [record.title for record in self.queue]
+
+    def test_records(self):
+        self.assertEqual(len(self.queue), 5)
+        record = self.queue[2]
+        self.assertIsInstance(record, QueueRecord)
+        self.assertEqual(record.title, 'Song 2')
+        self.assertEqual(record.uri, 'x-file:2')
+        self.assertEqual(record.protocol_info, 'x-file:*:*:*')
+        self.assertIsNone(record.album_art_uri)
+
+    def test_item_without_resources(self):
+        item = SimpleNamespace(title = 'Stream', creator = None)
+        self.queue.append(item)
+        self.assertEqual(self.queue[5].title, 'Stream')
+        self.assertIsNone(self.queue[5].uri)
+
+    def test_repeated_values_are_shared(self):
+        queue = CompactQueue()
+        # Equal strings, but distinct objects
+        queue.extend(track(number, creator = ''.join(['Art', 'ist']))
+                     for number in range(3))
+        creators = [record.creator for record in queue]
+        self.assertIs(creators[0], creators[1])
+        self.assertIs(creators[1], creators[2])
+
+    def test_remove(self):
+        self.queue.remove([1, 3])
+        self.assertEqual(self.titles(), ['Song 0', 'Song 2', 'Song 4'])
+
+    def test_reorder(self):
+        self.queue.reorder(move_order(5, [3, 4], 0))
+        self.assertEqual(self.titles(),
+                         ['Song 3', 'Song 4', 'Song 0', 'Song 1', 'Song 2'])
+
+    def test_keys_follow_entries(self):
+        key = self.queue.key(3)
+        self.queue.reorder(move_order(5, [3], 0))
+        self.assertEqual(self.queue.position(key), 0)
+        self.queue.remove([1])
+        self.assertEqual(self.queue.position(key), 0)
+        self.assertEqual(self.queue[self.queue.position(self.queue.key(1))].title, 'Song 1')
+
+    def test_find_uri_after_edits(self):
+        self.queue.reorder(move_order(5, [4], 0))
+        self.assertEqual(self.queue.find_uri('x-file:4'), 0)
+        self.queue.remove([0])
+        self.assertIsNone(self.queue.find_uri('x-file:4'))
+        self.assertEqual(self.queue.find_uri('x-file:0'), 0)
+
+    def test_every_change_bumps_version(self):
+        versions = [self.queue.version]
+        self.queue.append(track(5))
+        versions.append(self.queue.version)
+        self.queue.remove([0])
+        versions.append(self.queue.version)
+        self.queue.reorder([1, 0, 2, 3, 4])
+        versions.append(self.queue.version)
+        self.queue.clear()
+        versions.append(self.queue.version)
+        self.assertEqual(len(set(versions)), len(versions))
+
+    def test_label(self):
+        self.assertEqual(self.queue.label(1, '{} - {}'), 'Artist - Song 1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import health
+from health import HealthRegistry, SpeakerUnavailable
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def refuse():
+    raise ConnectionRefusedError('refused')
+
+
+class HealthRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(health.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.registry = HealthRegistry()
+
+    def fail(self, times = 1):
+        for attempt in range(times):
+            with self.assertRaises(OSError):
+                self.registry.call('speaker', refuse)
+
+    def state(self):
+        return self.registry.get('speaker').state
+
+    def test_opens_after_threshold(self):
+        self.fail(health.FAILURE_THRESHOLD - 1)
+        self.assertEqual(self.state(), health.CLOSED)
+        self.fail()
+        self.assertEqual(self.state(), health.OPEN)
+
+        with self.assertRaises(SpeakerUnavailable):
+            self.registry.call('speaker', lambda: 'called')
+
+    def test_success_resets_failures(self):
+        self.fail(health.FAILURE_THRESHOLD - 1)
+        self.assertEqual(self.registry.call('speaker', lambda: 'ok'), 'ok')
+        self.fail(health.FAILURE_THRESHOLD - 1)
+        self.assertEqual(self.state(), health.CLOSED)
+
+    def test_upnp_errors_are_not_failures(self):
+        def upnp_error():
+            raise ValueError('error reply')
+
+        for attempt in range(health.FAILURE_THRESHOLD + 1):
+            with self.assertRaises(ValueError):
+                self.registry.call('speaker', upnp_error)
+        self.assertEqual(self.state(), health.CLOSED)
+
+    def test_single_probe_after_backoff(self):
+        self.fail(health.FAILURE_THRESHOLD)
+        self.clock.now += health.BACKOFF_START
+
+        speaker = self.registry.get('speaker')
+        self.assertTrue(speaker.allow(self.clock.now))
+        self.assertEqual(speaker.state, health.HALF_OPEN)
+        # Only one call gets through while the probe is out
+        self.assertFalse(speaker.allow(self.clock.now))
+
+    def test_successful_probe_closes(self):
+        self.fail(health.FAILURE_THRESHOLD)
+        self.clock.now += health.BACKOFF_START
+        self.assertEqual(self.registry.call('speaker', lambda: 'ok'), 'ok')
+        self.assertEqual(self.state(), health.CLOSED)
+        self.assertEqual(self.registry.get('speaker').backoff, health.BACKOFF_START)
+
+    def test_failed_probe_doubles_backoff(self):
+        self.fail(health.FAILURE_THRESHOLD)
+        self.clock.now += health.BACKOFF_START
+        self.fail()
+
+        speaker = self.registry.get('speaker')
+        self.assertEqual(speaker.state, health.OPEN)
+        self.assertEqual(speaker.retry_at, self.clock.now + health.BACKOFF_START * 2)
+
+    def test_backoff_is_capped(self):
+        self.fail(health.FAILURE_THRESHOLD)
+        for attempt in range(10):
+            self.clock.now = self.registry.get('speaker').retry_at
+            self.fail()
+        self.assertEqual(self.registry.get('speaker').backoff, health.BACKOFF_MAX)
+
+    def test_describe_is_stable(self):
+        self.fail(health.FAILURE_THRESHOLD)
+        speaker = self.registry.get('speaker')
+        self.assertEqual(speaker.describe(), 'offline')
+        self.clock.now += 1
+        self.assertEqual(speaker.describe(), 'offline')
+
+    def test_slow_speaker_is_degraded(self):
+        speaker = self.registry.get('speaker')
+        speaker.success(health.LATENCY_SLOW * 2)
+        self.assertTrue(speaker.degraded())
+        self.assertEqual(speaker.describe(), 'slow')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import sys
+import unittest
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import metrics
+import perf
+from metrics import Registry
+
+
+class ExpositionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.enabled = True
+
+    def lines(self):
+        return self.registry.exposition().splitlines()
+
+    def test_empty(self):
+        self.assertEqual(self.registry.exposition(), '\n')
+
+    def test_histogram(self):
+        labels = (('method', 'get_queue'), ('speaker', '10.0.0.1'), ('zone', 'Kitchen'))
+        self.registry.observe('sonos_tk_soco_call_seconds', labels, 0.003)
+        self.registry.observe('sonos_tk_soco_call_seconds', labels, 0.2)
+        self.registry.observe('sonos_tk_soco_call_seconds', labels, 20.0)
+        lines = self.lines()
+
+        self.assertEqual(lines[0], '# HELP sonos_tk_soco_call_seconds '
+                                   'Duration of calls to speakers.')
+        self.assertEqual(lines[1], '# TYPE sonos_tk_soco_call_seconds histogram')
+        series = 'method="get_queue",speaker="10.0.0.1",zone="Kitchen"'
+        # Buckets are cumulative, +Inf holds every observation
+        self.assertIn('sonos_tk_soco_call_seconds_bucket{%s,le="0.001"} 0' % series, lines)
+        self.assertIn('sonos_tk_soco_call_seconds_bucket{%s,le="0.005"} 1' % series, lines)
+        self.assertIn('sonos_tk_soco_call_seconds_bucket{%s,le="0.25"} 2' % series, lines)
+        self.assertIn('sonos_tk_soco_call_seconds_bucket{%s,le="10"} 2' % series, lines)
+        self.assertIn('sonos_tk_soco_call_seconds_bucket{%s,le="+Inf"} 3' % series, lines)
+        self.assertIn('sonos_tk_soco_call_seconds_sum{%s} 20.203' % series, lines)
+        self.assertIn('sonos_tk_soco_call_seconds_count{%s} 3' % series, lines)
+        self.assertEqual(len(lines), 2 + len(metrics.BUCKETS) + 3)
+
+    def test_bucket_bound_is_inclusive(self):
+        self.registry.observe('sonos_tk_ui_stall_seconds', (), 0.5)
+        self.assertIn('sonos_tk_ui_stall_seconds_bucket{le="0.25"} 0', self.lines())
+        self.assertIn('sonos_tk_ui_stall_seconds_bucket{le="0.5"} 1', self.lines())
+
+    def test_counter(self):
+        self.registry.inc('sonos_tk_art_dedup_total', ())
+        self.registry.inc('sonos_tk_art_dedup_total', (), 2)
+        self.assertEqual(self.lines(), [
+            '# HELP sonos_tk_art_dedup_total Downloaded album art already cached under another URL.',
+            '# TYPE sonos_tk_art_dedup_total counter',
+            'sonos_tk_art_dedup_total 3'])
+
+    def test_label_values_are_escaped(self):
+        self.registry.inc('sonos_tk_soco_call_errors_total',
+                          (('zone', 'Living "Room"\\1\nUp'), ))
+        self.assertIn('sonos_tk_soco_call_errors_total{zone="Living \\"Room\\"\\\\1\\nUp"} 1',
+                      self.lines())
+
+    def test_speaker_call(self):
+        with self.assertRaises(OSError):
+            with self.registry.speaker_call('play', '10.0.0.1', None):
+                raise ConnectionRefusedError('refused')
+        lines = self.lines()
+        series = 'method="play",speaker="10.0.0.1",zone=""'
+        self.assertIn('sonos_tk_soco_call_seconds_count{%s} 1' % series, lines)
+        self.assertIn('sonos_tk_soco_call_errors_total{%s,error="ConnectionRefusedError"} 1'
+                      % series, lines)
+
+    def test_disabled_speaker_call_is_a_no_op(self):
+        self.registry.enabled = False
+        with self.registry.speaker_call('play', '10.0.0.1', 'Kitchen'):
+            pass
+        self.assertEqual(self.registry.exposition(), '\n')
+
+
+class PerfListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_database_spans(self):
+        self.registry.record('db.library', 0.002)
+        self.registry.count('db.library.errors')
+        lines = self.registry.exposition().splitlines()
+        self.assertIn('sonos_tk_db_query_seconds_count{query="library"} 1', lines)
+        self.assertIn('sonos_tk_db_query_errors_total{query="library"} 1', lines)
+
+    def test_mapped_names(self):
+        self.registry.record('ui.loop_lag', 0.01)
+        self.registry.count('art.cache.hit')
+        self.registry.count('art.cache.hit')
+        self.registry.count('art.cache.miss')
+        lines = self.registry.exposition().splitlines()
+        self.assertIn('sonos_tk_ui_loop_lag_seconds_count 1', lines)
+        self.assertIn('sonos_tk_art_cache_lookups_total{result="hit"} 2', lines)
+        self.assertIn('sonos_tk_art_cache_lookups_total{result="miss"} 1', lines)
+
+    def test_other_names_are_ignored(self):
+        # Speaker calls are timed by speaker_call() with their labels
+        self.registry.record('soco.get_queue', 0.1)
+        self.registry.count('queue.rows')
+        self.assertEqual(self.registry.exposition(), '\n')
+
+
+class ServeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, metrics.registry, 'enabled', metrics.registry.enabled)
+        self.addCleanup(setattr, perf.recorder, 'listeners', list(perf.recorder.listeners))
+
+    def test_serves_metrics(self):
+        server = metrics.serve(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.assertIn(metrics.registry, perf.recorder.listeners)
+
+        metrics.registry.inc('sonos_tk_ui_stalls_total', ())
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_port)
+        with urllib.request.urlopen(url, timeout = 5) as response:
+            self.assertEqual(response.headers['Content-Type'], metrics.CONTENT_TYPE)
+            self.assertIn('sonos_tk_ui_stalls_total', response.read().decode('utf-8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from queue_model import CompactQueue, QueueIndex, move_order
+
+
+def track(number, creator = 'Artist', album = 'Album'):
+    return SimpleNamespace(item_id = 'Q:0/{}'.format(number),
+                           parent_id = 'Q:0',
+                           item_class = 'object.item.audioItem.musicTrack',
+                           title = 'Song {}'.format(number),
+                           creator = creator,
+                           album = album,
+                           album_art_uri = None,
+                           resources = [SimpleNamespace(uri = 'x-file:{}'.format(number),
+                                                        protocol_info = 'x-file:*:*:*')])
+
+
+class QueueIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = QueueIndex()
+        self.index.add(1, ['Hello World'])
+        self.index.add(2, ['Help me'])
+        self.index.add(3, ['Hello', 'Again'])
+
+    def test_prefix_search(self):
+        self.assertEqual(self.index.search('hel'), {1, 2, 3})
+        self.assertEqual(self.index.search('wor hel'), {1})
+        self.assertEqual(self.index.search('HELLO'), {1, 3})
+        self.assertEqual(self.index.search('nothing'), set())
+
+    def test_query_without_words(self):
+        self.assertIsNone(self.index.search(' - '))
+
+    def test_tokens_added_after_a_search(self):
+        self.assertEqual(self.index.search('wor'), {1})
+        self.index.add(4, ['Wonderful'])
+        self.assertEqual(self.index.search('wo'), {1, 4})
+
+    def test_remove(self):
+        self.index.remove([(1, ['Hello World'])])
+        self.assertEqual(self.index.search('hel'), {2, 3})
+        self.assertEqual(self.index.search('world'), set())
+        self.assertNotIn('world', self.index._postings)
+
+    def test_remove_several_keys_of_a_token(self):
+        self.index.remove([(1, ['Hello World']), (3, ['Hello', 'Again'])])
+        self.assertEqual(self.index.search('hello'), set())
+        self.assertEqual(self.index.search('help'), {2})
+
+    def test_remove_then_add(self):
+        self.index.remove([(2, ['Help me'])])
+        self.assertEqual(self.index.search('help'), set())
+        self.index.add(4, ['Help'])
+        self.assertEqual(self.index.search('help'), {4})
+
+    def test_clear(self):
+        self.index.clear()
+        self.assertEqual(self.index.search('hello'), set())
+
+
+class CompactQueueSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = CompactQueue()
+        self.queue.extend(track(number, creator = 'Artist {}'.format(number % 3))
+                          for number in range(10))
+
+    def titles(self, positions):
+        return [self.queue[position].title for position in positions]
+
+    def test_search_in_queue_order(self):
+        self.assertEqual(self.titles(self.queue.search('artist 1')),
+                         ['Song 1', 'Song 4', 'Song 7'])
+        self.assertIsNone(self.queue.search(''))
+
+    def test_search_after_remove(self):
+        self.queue.remove([0, 3, 4])
+        self.assertEqual(self.titles(self.queue.search('artist 0')),
+                         ['Song 6', 'Song 9'])
+        self.assertEqual(self.queue.search('song 3'), [])
+
+    def test_search_after_reorder(self):
+        self.queue.reorder(move_order(len(self.queue), [8, 9], 0))
+        self.assertEqual(self.queue.search('song 9'), [1])
+        self.assertEqual(self.titles(self.queue.search('artist 2')),
+                         ['Song 8', 'Song 2', 'Song 5'])
+
+    def test_search_after_clear(self):
+        self.queue.clear()
+        self.queue.append(track(42))
+        self.assertEqual(self.queue.search('song'), [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from queue_model import move_order, reorder_ops, runs
+
+
+def apply_ops(items, ops):
+    # What ReorderTracksInQueue does to the queue, one move at a time
+    items = list(items)
+    for start, count, insert_before in ops:
+        block = items[start:start + count]
+        del items[start:start + count]
+        if insert_before > start:
+            insert_before -= count
+        items[insert_before:insert_before] = block
+    return items
+
+
+class RunsTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(runs([]), [])
+
+    def test_contiguous_runs_in_queue_order(self):
+        self.assertEqual(runs([7, 1, 2, 3, 9, 8, 12]),
+                         [(1, 3), (7, 3), (12, 1)])
+
+    def test_duplicates(self):
+        self.assertEqual(runs([4, 4, 5]), [(4, 2)])
+
+
+class MoveOrderTest(unittest.TestCase):
+
+    def test_move_to_front(self):
+        self.assertEqual(move_order(5, [3, 4], 0), [3, 4, 0, 1, 2])
+
+    def test_move_to_end(self):
+        self.assertEqual(move_order(5, [0, 2], 5), [1, 3, 4, 0, 2])
+
+    def test_insert_before_selected_entry(self):
+        # The entry to insert before is moved itself, the others close up
+        self.assertEqual(move_order(5, [1, 2], 2), [0, 1, 2, 3, 4])
+
+
+class ReorderOpsTest(unittest.TestCase):
+
+    def test_identity_needs_no_moves(self):
+        self.assertEqual(reorder_ops(list(range(10))), [])
+
+    def test_block_is_one_move(self):
+        order = move_order(10, [6, 7, 8], 1)
+        ops = reorder_ops(order)
+        self.assertEqual(len(ops), 1)
+        self.assertEqual(apply_ops(range(10), ops), order)
+
+    def test_random_moves(self):
+        rand = random.Random(1234)
+        for attempt in range(500):
+            length = rand.randint(1, 40)
+            positions = rand.sample(range(length), rand.randint(1, length))
+            order = move_order(length, positions, rand.randint(0, length))
+            self.assertEqual(apply_ops(range(length), reorder_ops(order)), order)
+
+    def test_random_permutations(self):
+        rand = random.Random(4321)
+        for attempt in range(200):
+            order = list(range(rand.randint(1, 30)))
+            rand.shuffle(order)
+            self.assertEqual(apply_ops(range(len(order)), reorder_ops(order)), order)
+
+
+if __name__ == '__main__':
+    unittest.main()
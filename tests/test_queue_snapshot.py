@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import queue_model
+from queue_model import CompactQueue
+
+
+def track(number, creator = 'Artist', album = 'Album'):
+    return SimpleNamespace(item_id = 'Q:0/{}'.format(number),
+                           parent_id = 'Q:0',
+                           item_class = 'object.item.audioItem.musicTrack',
+                           title = 'Song {}'.format(number),
+                           creator = creator,
+                           album = album,
+                           album_art_uri = None,
+                           resources = [SimpleNamespace(uri = 'x-file:{}'.format(number),
+                                                        protocol_info = 'x-file:*:*:*')])
+
+
+class QueueSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = CompactQueue()
+        self.queue.extend(track(number, creator = 'Artist {}'.format(number % 3))
+                          for number in range(10))
+
+    def test_round_trip(self):
+        self.queue.update_id = 42
+        self.queue.remove([2])
+        restored = CompactQueue()
+        restored.load_bytes(self.queue.to_bytes())
+
+        self.assertEqual(restored.update_id, 42)
+        self.assertEqual(len(restored), len(self.queue))
+        for index in range(len(self.queue)):
+            for name in queue_model.FIELDS:
+                self.assertEqual(getattr(restored[index], name),
+                                 getattr(self.queue[index], name))
+
+    def test_restored_queue_is_searchable(self):
+        restored = CompactQueue()
+        restored.load_bytes(self.queue.to_bytes())
+        self.assertEqual(restored.search('artist 1'), self.queue.search('artist 1'))
+        self.assertEqual(restored.find_uri('x-file:7'), 7)
+
+    def test_empty_round_trip(self):
+        restored = CompactQueue()
+        restored.load_bytes(CompactQueue().to_bytes())
+        self.assertEqual(len(restored), 0)
+        self.assertIsNone(restored.update_id)
+
+    def test_versions_are_unique_across_queues(self):
+        # A queue swapped in after a reload must not look like the one
+        # saved before it
+        versions = set()
+        for attempt in range(3):
+            queue = CompactQueue()
+            versions.add(queue.version)
+            queue.append(track(attempt))
+            versions.add(queue.version)
+        self.assertEqual(len(versions), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
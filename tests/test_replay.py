@@ -0,0 +1,151 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import replay
+from replay import Player, Recorder, ReplayMissing, call_key
+
+
+class UPnPError(Exception):
+    # Like SoCo's errors, the constructor arguments don't match args
+    def __init__(self, message, error_code):
+        super(UPnPError, self).__init__(message)
+        self.error_code = error_code
+
+
+class CallKeyTest(unittest.TestCase):
+
+    def test_arguments(self):
+        self.assertEqual(call_key('get_queue', (0, 100), {}), 'get_queue(0, 100)')
+
+    def test_keyword_arguments_are_sorted(self):
+        self.assertEqual(call_key('play', (), {'b': 2, 'a': 'x'}),
+                         call_key('play', (), {'a': 'x', 'b': 2}))
+        self.assertEqual(call_key('play', (), {'b': 2, 'a': 'x'}), "play(a='x', b=2)")
+
+    def test_didl_objects_by_item_id(self):
+        item = SimpleNamespace(item_id = 'Q:0/1', title = 'Changes every time')
+        self.assertEqual(call_key('add_to_queue', ([item],), {}),
+                         'add_to_queue([<SimpleNamespace Q:0/1>])')
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'session.jsonl')
+        self.recorder = Recorder(self.path)
+        self.addCleanup(self.recorder.close)
+
+    def play(self):
+        self.recorder.close()
+        return Player(self.path, latency = 0)
+
+    def test_calls_replay_in_order_then_repeat_last(self):
+        answers = iter([{'volume': 10}, {'volume': 20}])
+        call = self.recorder.wrap_call(lambda speaker, method: next(answers))
+        speaker = SimpleNamespace(ip_address = '10.0.0.1')
+        call(speaker, 'status')
+        call(speaker, 'status')
+
+        player = self.play()
+        speaker = player.speaker('10.0.0.1')
+        self.assertEqual(player.call(speaker, 'status'), {'volume': 10})
+        self.assertEqual(player.call(speaker, 'status'), {'volume': 20})
+        self.assertEqual(player.call(speaker, 'status'), {'volume': 20})
+
+    def test_missing_call(self):
+        player = self.play()
+        with self.assertRaises(ReplayMissing):
+            player.call(player.speaker('10.0.0.1'), 'status')
+        self.assertIsInstance(ReplayMissing(), LookupError)
+
+    def test_errors_are_replayed(self):
+        errors = iter([ConnectionRefusedError('refused'), UPnPError('busy', 701)])
+
+        def invoke(speaker, method):
+            raise next(errors)
+
+        call = self.recorder.wrap_call(invoke)
+        speaker = SimpleNamespace(ip_address = '10.0.0.1')
+        with self.assertRaises(OSError):
+            call(speaker, 'play')
+        with self.assertRaises(UPnPError):
+            call(speaker, 'pause')
+
+        player = self.play()
+        speaker = player.speaker('10.0.0.1')
+        with self.assertRaises(ConnectionRefusedError):
+            player.call(speaker, 'play')
+        with self.assertRaises(replay.RecordedError) as context:
+            player.call(speaker, 'pause')
+        self.assertNotIsInstance(context.exception, OSError)
+        self.assertIn('UPnPError: busy', str(context.exception))
+
+    def test_unpicklable_os_error_stays_os_error(self):
+        class SocketError(OSError):
+            def __init__(self, host):
+                super(SocketError, self).__init__('unreachable {}'.format(host))
+
+        def invoke(speaker, method):
+            raise SocketError('10.0.0.1')
+
+        speaker = SimpleNamespace(ip_address = '10.0.0.1')
+        with self.assertRaises(OSError):
+            self.recorder.wrap_call(invoke)(speaker, 'play')
+
+        player = self.play()
+        with self.assertRaises(replay.RecordedOSError):
+            player.call(player.speaker('10.0.0.1'), 'play')
+
+    def test_speaker_info_is_kept(self):
+        call = self.recorder.wrap_call(lambda speaker, method: {'uid': 'RINCON_1'})
+        call(SimpleNamespace(ip_address = '10.0.0.1'), 'get_speaker_info')
+
+        player = self.play()
+        speaker = player.speaker('10.0.0.1')
+        player.call(speaker, 'get_speaker_info')
+        self.assertEqual(speaker.speaker_info, {'uid': 'RINCON_1'})
+        self.assertIs(player.speaker('10.0.0.1'), speaker)
+
+    def test_discover_order(self):
+        found = [SimpleNamespace(ip_address = address)
+                 for address in ('10.0.0.3', '10.0.0.1', '10.0.0.2')]
+        self.recorder.wrap_discover(lambda: found)()
+
+        player = self.play()
+        self.assertEqual([speaker.ip_address for speaker in player.discover()],
+                         ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+
+    def test_discover_without_recorded_discovery(self):
+        call = self.recorder.wrap_call(lambda speaker, method: None)
+        call(SimpleNamespace(ip_address = '10.0.0.2'), 'status')
+        call(SimpleNamespace(ip_address = '10.0.0.1'), 'status')
+
+        player = self.play()
+        self.assertEqual([speaker.ip_address for speaker in player.discover()],
+                         ['10.0.0.2', '10.0.0.1'])
+
+    def test_fetch(self):
+        self.recorder.wrap_fetch(lambda url, timeout = None: b'image')('http://art')
+
+        player = self.play()
+        self.assertEqual(player.fetch('http://art', timeout = 5), b'image')
+
+    def test_notes(self):
+        self.recorder.note('selected', 'RINCON_1')
+        self.recorder.note('selected', 'RINCON_2')
+
+        player = self.play()
+        self.assertEqual(player.note('selected'), 'RINCON_1')
+        self.assertIsNone(player.note('other'))
+
+
+if __name__ == '__main__':
+    unittest.main()